@@ -36,4 +36,33 @@ export const analyzeAudio = async (
 
   // 結果をJSONとして返す
   return await res.json();
-};
\ No newline at end of file
+};
+
+// リズム分類・音高推定（・Whisper）を1回のアップロードでまとめて行う関数。
+// サーバーは音声を1度だけデコードし、各解析を並行に実行して1つのJSONで返す。
+// 戻り値の segments は /predict、pitch_series は /pitch、whisper は /analyze と同じ形式。
+export type Analysis = 'rhythm' | 'pitch' | 'whisper';
+
+export const analyzeAll = async (
+  blob: Blob,
+  tempo: number,
+  barCount: number,
+  analyses: Analysis[] = ['rhythm', 'pitch']
+): Promise<any> => {
+  const formData = new FormData();
+  formData.append('file', blob);
+  formData.append('tempo', tempo.toString());
+  formData.append('bar_count', barCount.toString());
+  formData.append('analyses', analyses.join(','));
+
+  const res = await fetch(`${baseUrl}/analyze_all`, {
+    method: 'POST',
+    body: formData,
+  });
+
+  if (!res.ok) {
+    throw new Error(`Analysis request failed with status ${res.status}`);
+  }
+
+  return await res.json();
+};
@@ -0,0 +1,52 @@
+// 録音中の音声をサーバーに少しずつ送信し、録音と並行して解析させるためのヘルパー。
+// MediaRecorder を timeslice 付きで start し、ondataavailable の断片を push() で送る。
+// 録音停止後に finish() を呼ぶと、/predict・/pitch と同じ形式の解析結果が返る。
+const baseUrl = (import.meta.env.VITE_API_BASE_URL || '').replace(/\/$/, '');
+
+export type StreamKind = 'predict' | 'pitch';
+
+export type StreamSession = {
+  push: (chunk: Blob) => Promise<void>;
+  finish: () => Promise<any>;
+};
+
+export const startStreamAnalysis = async (
+  kind: StreamKind,
+  tempo: number,
+  barCount: number
+): Promise<StreamSession> => {
+  // セッションを開始
+  const formData = new FormData();
+  formData.append('kind', kind);
+  formData.append('tempo', tempo.toString());
+  formData.append('bar_count', barCount.toString());
+  const res = await fetch(`${baseUrl}/stream/start`, { method: 'POST', body: formData });
+  if (!res.ok) {
+    throw new Error(`Stream start failed with status ${res.status}`);
+  }
+  const { session } = await res.json();
+
+  // 断片は録音順にサーバーへ届く必要があるため、前の送信が終わってから次を送る
+  let queue: Promise<void> = Promise.resolve();
+
+  const push = (chunk: Blob) => {
+    queue = queue.then(async () => {
+      const res = await fetch(`${baseUrl}/stream/${session}/chunk`, { method: 'POST', body: chunk });
+      if (!res.ok) {
+        throw new Error(`Stream chunk failed with status ${res.status}`);
+      }
+    });
+    return queue;
+  };
+
+  const finish = async () => {
+    await queue;
+    const res = await fetch(`${baseUrl}/stream/${session}/finish`, { method: 'POST' });
+    if (!res.ok) {
+      throw new Error(`Stream finish failed with status ${res.status}`);
+    }
+    return await res.json();
+  };
+
+  return { push, finish };
+};
@@ -0,0 +1,322 @@
+# -----------------------------------------------
+# 解析APIの非同期（ASGI）版エントリーポイント
+# main_api（Flask + gunicorn gthread）と同じエンドポイントを、Starlette + uvicorn で提供する
+# ・アップロードの受信と ffmpeg の入出力は asyncio で待つため、遅いアップロードでもスレッドを占有しない
+# ・特徴量抽出・CREPE・Whisper・Keras などの CPU 処理は ASGI_WORKER_THREADS 個のスレッドプールで実行する
+# ・各エンドポイントの処理本体は predict_api / pitch_api / whisper_api / multi_api の関数をそのまま使う
+# 起動方法: uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+# （Docker では SERVER=asgi を指定する）
+# -----------------------------------------------
+import asyncio
+import contextvars
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse as StarletteJSONResponse
+from starlette.responses import PlainTextResponse
+from starlette.routing import Match, Route
+
+from audio_io import SAMPLE_RATE, DecoderBusy, decode_audio_async, decoder_stats
+from cpu_pool import cpu_pool
+from log_config import get_logger
+from metrics import begin_request, end_request, render_metrics, set_bar_count
+from model_registry import MODEL_LOAD_POLICY, models
+from multi_api import job_tasks, merge_results, needs_decode, parse_analyses, plan_jobs
+from pitch_api import crepe_version, new_pitch_entry, segment_entry
+from pitch_core import crepe_config
+from predict_api import FEATURE_MODE, batcher, classify_entry, log_predictions, new_rhythm_entry, rhythm_model_version
+from prediction_log import prediction_log
+from result_cache import analysis_store, cache_key, refresh_handle, result_cache
+from whisper_api import WHISPER_MODEL, classify_whisper_chunks
+
+ASGI_WORKER_THREADS = int(os.getenv("ASGI_WORKER_THREADS", os.cpu_count() or 4))
+logger = get_logger(__name__)
+
+# CPU 処理（特徴量抽出・推論）を実行するスレッドプール
+executor = ThreadPoolExecutor(max_workers=ASGI_WORKER_THREADS, thread_name_prefix="asgi-cpu")
+
+
+# Flask の jsonify と同じく NaN をそのまま出力する JSON レスポンス
+# （録音がチャンク分割より短い場合、pitch_series の rms などが NaN になるため）
+class JSONResponse(StarletteJSONResponse):
+    def render(self, content):
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# スレッドプールでも段階ごとの計測が同じリクエストに記録されるよう、contextvars を引き継いで実行する
+async def run_cpu(func, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, func, *args))
+
+
+# フォームの tempo / bar_count を取り出す（Flask版と同じ既定値）
+def tempo_and_bars(form):
+    set_bar_count(form.get("bar_count", ""))
+    return float(form.get("tempo", 120)), int(form.get("bar_count", 1))
+
+
+# リクエストに一致するルートのパターンを返す（一致しなければ "unmatched"。main_api の url_rule と同じラベル）
+# 生のパスをラベルにすると、URL ごとにメトリクスの系列が増え続けるため
+def route_pattern(scope):
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+# main_api の before_request / after_request と同じ処理時間の計測
+class MetricsMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        timer = begin_request(route_pattern(request.scope))
+        try:
+            response = await call_next(request)
+        except Exception:
+            end_request(timer, 500)  # 処理されなかった例外も Flask 版と同じく 500 として記録する
+            raise
+        server_timing = end_request(timer, response.status_code)
+        if server_timing:
+            response.headers["Server-Timing"] = server_timing
+        return response
+
+
+async def health(request):
+    return JSONResponse({"ok": True})
+
+
+async def stats(request):
+    return JSONResponse({
+        "inference": batcher.stats(),
+        "decoder": decoder_stats(),
+        "models": models.status(),
+        "result_cache": result_cache.stats(),
+        "analysis_store": analysis_store.stats(),
+        "cpu_pool": cpu_pool.stats(),
+        "prediction_log": prediction_log.stats(),
+    })
+
+
+async def metrics(request):
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+async def warmup(request):
+    results = await run_cpu(models.warmup_all)
+    warmed = all(r["warmed"] for r in results.values())
+    return JSONResponse({"warmed": warmed, "models": results}, status_code=200 if warmed else 500)
+
+
+# /predict と同じ処理（音声の分割・特徴量抽出・分類）
+async def predict(request):
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None:
+        return JSONResponse({"error": "No file uploaded"}, status_code=400)
+    tempo, bar_count = tempo_and_bars(form)
+    data = await upload.read()
+
+    key = cache_key("predict", data, rhythm_model_version(), tempo=tempo, bar_count=bar_count)
+    cached = result_cache.get(key)
+    if cached is not None:
+        log_predictions(cached["segments"], tempo, bar_count, request.headers.get("x-request-id"))
+        return JSONResponse(refresh_handle(cached))
+
+    handle = cache_key("predict-frames", data, FEATURE_MODE)
+    entry = analysis_store.get(handle)
+    try:
+        if entry is None:
+            y = await decode_audio_async(data, executor=executor)
+            entry = await run_cpu(new_rhythm_entry, y, SAMPLE_RATE)
+            analysis_store.put(handle, entry)
+        results = await run_cpu(classify_entry, entry, tempo, bar_count)
+        log_predictions(results, tempo, bar_count, request.headers.get("x-request-id"))
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=503)
+    except Exception as e:
+        logger.exception("🔥 エラー発生: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    result = {"segments": results, "handle": handle}
+    result_cache.put(key, result)
+    return JSONResponse(result)
+
+
+# /pitch と同じ処理（CREPE による音高推定と16分割の判定）
+async def pitch(request):
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None:
+        return JSONResponse({"error": "No file uploaded"}, status_code=400)
+    tempo, bar_count = tempo_and_bars(form)
+    config = crepe_config(form)
+    data = await upload.read()
+
+    key = cache_key("pitch", data, crepe_version(config), tempo=tempo, bar_count=bar_count)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return JSONResponse(refresh_handle(cached))
+
+    handle = cache_key("pitch-frames", data, crepe_version(config))
+    entry = analysis_store.get(handle)
+    try:
+        if entry is None:
+            entry = new_pitch_entry(await decode_audio_async(data, executor=executor), config)
+            analysis_store.put(handle, entry)
+        segments = await run_cpu(segment_entry, entry, tempo, bar_count)
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=503)
+    except Exception as e:
+        logger.exception("❌ 音声読み込みまたはCREPE予測でエラー: %s", e)
+        return JSONResponse({"error": "Failed to load audio or predict pitch"}, status_code=500)
+
+    result = {"pitch_series": segments, "handle": handle}
+    result_cache.put(key, result)
+    return JSONResponse(result)
+
+
+# /analyze と同じ処理（Whisper の文字起こしによるリズム分類）
+async def analyze(request):
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None:
+        return JSONResponse({"error": "No file uploaded"}, status_code=400)
+    tempo, bar_count = tempo_and_bars(form)
+    data = await upload.read()
+
+    key = cache_key("analyze", data, f"whisper:{WHISPER_MODEL}", tempo=tempo, bar_count=bar_count)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return JSONResponse(cached)
+
+    try:
+        y = await decode_audio_async(data, executor=executor)
+    except DecoderBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+    result = await run_cpu(classify_whisper_chunks, y, SAMPLE_RATE, tempo, bar_count)
+    result_cache.put(key, result)
+    return JSONResponse(result)
+
+
+# /analyze_whisper と同じ処理（録音全体の文字起こし）
+async def analyze_whisper(request):
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None:
+        return JSONResponse({"error": "No file"}, status_code=400)
+    try:
+        y = await decode_audio_async(await upload.read(), executor=executor)
+    except DecoderBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+    result = await run_cpu(lambda: models.get("whisper").transcribe(y, language="ja"))
+    return JSONResponse({"text": result["text"]})
+
+
+# /analyze_all と同じ処理（1回のデコードでリズム・音高・Whisper の解析を並行に実行）
+async def analyze_all(request):
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None:
+        return JSONResponse({"error": "No file uploaded"}, status_code=400)
+    try:
+        analyses = parse_analyses(form.get("analyses"))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    tempo, bar_count = tempo_and_bars(form)
+    config = crepe_config(form)
+    data = await upload.read()
+
+    jobs = plan_jobs(data, analyses, tempo, bar_count, config)
+    try:
+        y = await decode_audio_async(data, executor=executor) if needs_decode(jobs) else None
+        tasks = job_tasks(jobs, y, tempo, bar_count, config)
+        outputs = dict(zip(tasks, await asyncio.gather(*(run_cpu(func) for func in tasks.values()))))
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=503)
+    except Exception as e:
+        logger.exception("🔥 エラー発生: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    return JSONResponse(merge_results(jobs, outputs, tempo, bar_count, request.headers.get("x-request-id")))
+
+
+# /predict/resegment・/pitch/resegment と同じ処理（保持している中間結果から再分割）
+async def resegment(request):
+    kind = "rhythm" if request.url.path.startswith("/predict") else "pitch"
+    form = await request.form()
+    handle = form.get("handle")
+    tempo, bar_count = tempo_and_bars(form)
+
+    entry = analysis_store.get(handle) if handle else None
+    if entry is None or entry["kind"] != kind:
+        return JSONResponse({"error": "Unknown or expired handle, please upload the file again"}, status_code=404)
+
+    try:
+        if kind == "rhythm":
+            results = await run_cpu(classify_entry, entry, tempo, bar_count)
+            log_predictions(results, tempo, bar_count, request.headers.get("x-request-id"))
+            return JSONResponse({"segments": results, "handle": handle})
+        segments = await run_cpu(segment_entry, entry, tempo, bar_count)
+        return JSONResponse({"pitch_series": segments, "handle": handle})
+    except Exception as e:
+        logger.exception("❌ 再分割でエラー: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+# 起動時のモデル読み込み（main_api と同じ MODEL_LOAD_POLICY に従う）
+@asynccontextmanager
+async def lifespan(app):
+    if MODEL_LOAD_POLICY == "eager":
+        await run_cpu(models.load_all)
+        await run_cpu(cpu_pool.warmup)
+    elif MODEL_LOAD_POLICY == "background":
+        models.warmup_in_background()
+    yield
+    executor.shutdown(wait=False)
+
+
+# main_api と同じく、ローカル開発環境・Vercel・PROD_ORIGIN だけを許可する
+allowed_origins = ["http://localhost:5173"]
+prod_origin = os.getenv("PROD_ORIGIN")
+if prod_origin:
+    allowed_origins.append(prod_origin)
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/stats", stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/warmup", warmup, methods=["GET"]),
+        Route("/predict", predict, methods=["POST"]),
+        Route("/predict/resegment", resegment, methods=["POST"]),
+        Route("/pitch", pitch, methods=["POST"]),
+        Route("/pitch/resegment", resegment, methods=["POST"]),
+        Route("/analyze", analyze, methods=["POST"]),
+        Route("/analyze_whisper", analyze_whisper, methods=["POST"]),
+        Route("/analyze_all", analyze_all, methods=["POST"]),
+    ],
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(
+            CORSMiddleware,
+            allow_origins=allowed_origins,
+            allow_origin_regex=r"^https://.*\.vercel\.app$",
+            allow_methods=["GET", "POST", "OPTIONS"],
+            allow_headers=["Content-Type", "Authorization"],
+            expose_headers=["Content-Type", "Server-Timing"],
+            max_age=86400,
+        ),
+    ],
+    lifespan=lifespan,
+)
+
+__all__ = ["app"]
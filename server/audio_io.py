@@ -0,0 +1,258 @@
+# -----------------------------------------------
+# アップロード音声のデコード処理（各APIで共通）
+# アップロードされたバイト列を 16kHz モノラル float32 PCM の NumPy 配列にデコードする
+# 一時ファイル（webm / wav）の書き込み・読み込みは行わない
+# ・DECODER_BACKEND=ffmpeg: ffmpeg の標準入力へ流し込み、標準出力からPCMを受け取る（既定）
+# ・DECODER_BACKEND=av: PyAV を使ってプロセス内でデコードする（プロセス起動コストなし）
+# 同時デコード数は DECODER_CONCURRENCY で制限し、空き待ちが
+# DECODER_QUEUE_TIMEOUT 秒を超えた場合は DecoderBusy を送出する（バックプレッシャー）
+# 録音中のストリーミング送信（stream_api.py）用に、ffmpeg を起動したままにして
+# 届いたバイト列を順次デコードする StreamDecoder も提供する（セッションの間、同時デコード数の枠を1つ使う）
+# ASGI版（asgi_app.py）用に、ffmpeg を asyncio のサブプロセスとして動かす decode_audio_async も提供する
+# -----------------------------------------------
+import asyncio
+import io
+import os
+import threading
+
+import ffmpeg
+import numpy as np
+
+from metrics import stage
+
+# 各APIで扱うサンプリングレート（Hz）
+SAMPLE_RATE = 16000
+
+DECODER_BACKEND = os.getenv("DECODER_BACKEND", "ffmpeg")
+DECODER_CONCURRENCY = int(os.getenv("DECODER_CONCURRENCY", os.cpu_count() or 2))
+DECODER_QUEUE_TIMEOUT = float(os.getenv("DECODER_QUEUE_TIMEOUT", 10))
+
+
+class DecoderBusy(Exception):
+    """デコーダーの空きを待つ間にタイムアウトした（サーバー混雑）"""
+
+
+# 同時に動かせるデコーダー数の上限（ffmpeg プロセスの起動しすぎを防ぐ）
+_slots = threading.BoundedSemaphore(DECODER_CONCURRENCY)
+_stats_lock = threading.Lock()
+_stats = {"active": 0, "waiting": 0, "decoded": 0, "rejected": 0}
+
+
+# ffmpeg バックエンド: 標準入出力のパイプでデコード
+def _decode_ffmpeg(data, sr):
+    out, _ = (
+        ffmpeg
+        .input("pipe:0")
+        .output("pipe:1", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .run(input=data, capture_stdout=True, capture_stderr=True)
+    )
+    # frombuffer は読み取り専用になるため、書き込み可能な配列としてコピーして返す
+    return np.frombuffer(out, dtype=np.float32).copy()
+
+
+# PyAV バックエンド: プロセス内でデコードとリサンプリングを行う
+def _decode_av(data, sr):
+    import av
+
+    chunks = []
+    with av.open(io.BytesIO(data)) as container:
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sr)
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        # リサンプラー内に残ったサンプルを取り出す
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+
+_BACKENDS = {"ffmpeg": _decode_ffmpeg, "av": _decode_av}
+
+
+# デコーダーの空きを待って1つ確保する（DECODER_QUEUE_TIMEOUT 秒を超えたら DecoderBusy）
+def _acquire_slot():
+    with _stats_lock:
+        _stats["waiting"] += 1
+    with stage("decode_queue"):
+        acquired = _slots.acquire(timeout=DECODER_QUEUE_TIMEOUT)
+    with _stats_lock:
+        _stats["waiting"] -= 1
+        if not acquired:
+            _stats["rejected"] += 1
+        else:
+            _stats["active"] += 1
+    if not acquired:
+        raise DecoderBusy("decoder is busy, please retry later")
+
+
+def _release_slot():
+    _slots.release()
+    with _stats_lock:
+        _stats["active"] -= 1
+        _stats["decoded"] += 1
+
+
+def decode_audio(data, sr=SAMPLE_RATE):
+    """音声ファイルのバイト列を sr Hz モノラル float32 のPCM配列にデコードする"""
+    decode = _BACKENDS.get(DECODER_BACKEND)
+    if decode is None:
+        raise ValueError(f"unknown DECODER_BACKEND: {DECODER_BACKEND}")
+
+    _acquire_slot()
+    try:
+        with stage("decode"):
+            return decode(data, sr)
+    finally:
+        _release_slot()
+
+
+# asyncio 用の同時デコード数の上限（イベントループ内で初回利用時に作る）
+_async_slots = None
+
+
+async def _decode_ffmpeg_async(data, sr):
+    args = ffmpeg.input("pipe:0").output("pipe:1", format="f32le", acodec="pcm_f32le", ac=1, ar=sr).compile()
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate(input=data)
+    if proc.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", out, err)
+    return np.frombuffer(out, dtype=np.float32).copy()
+
+
+async def decode_audio_async(data, sr=SAMPLE_RATE, executor=None):
+    """decode_audio の asyncio 版（ffmpeg の入出力を待つ間、イベントループをブロックしない）
+
+    DECODER_BACKEND=av の場合は、プロセス内デコードを executor のスレッドで実行する
+    """
+    global _async_slots
+    if DECODER_BACKEND not in _BACKENDS:
+        raise ValueError(f"unknown DECODER_BACKEND: {DECODER_BACKEND}")
+    if _async_slots is None:
+        _async_slots = asyncio.Semaphore(DECODER_CONCURRENCY)
+
+    with _stats_lock:
+        _stats["waiting"] += 1
+    try:
+        with stage("decode_queue"):
+            await asyncio.wait_for(_async_slots.acquire(), timeout=DECODER_QUEUE_TIMEOUT)
+        acquired = True
+    except asyncio.TimeoutError:
+        acquired = False
+    with _stats_lock:
+        _stats["waiting"] -= 1
+        if not acquired:
+            _stats["rejected"] += 1
+        else:
+            _stats["active"] += 1
+    if not acquired:
+        raise DecoderBusy("decoder is busy, please retry later")
+
+    try:
+        with stage("decode"):
+            if DECODER_BACKEND == "av":
+                return await asyncio.get_running_loop().run_in_executor(executor, _decode_av, data, sr)
+            return await _decode_ffmpeg_async(data, sr)
+    finally:
+        _async_slots.release()
+        with _stats_lock:
+            _stats["active"] -= 1
+            _stats["decoded"] += 1
+
+
+class StreamDecoder:
+    """ffmpeg を1プロセス起動したままにし、feed() で届いたバイト列を順次 sr Hz モノラル float32 PCM にデコードする
+
+    セッションの間はデコーダーの枠を1つ確保し続ける（DECODER_CONCURRENCY の上限に含める。空きがなければ DecoderBusy）
+    デコード済みの PCM は倍々に伸ばす配列に追記し、pcm() はコピーせずにそのビューを返す
+    """
+
+    def __init__(self, sr=SAMPLE_RATE):
+        self._lock = threading.Lock()
+        self._released = False
+        _acquire_slot()
+        try:
+            self._proc = (
+                ffmpeg
+                .input("pipe:0")
+                .output("pipe:1", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+                .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+            )
+        except Exception:
+            self._release()
+            raise
+        self._pcm = np.zeros(sr, dtype=np.float32)
+        self._length = 0
+        self._pending = b""  # 4バイトに満たない端数
+        # 標準出力・標準エラーを別スレッドで読み続ける（パイプが詰まって ffmpeg が止まらないように）
+        self._reader = threading.Thread(target=self._read_stdout, name="stream-decoder", daemon=True)
+        self._reader.start()
+        self._stderr = threading.Thread(target=self._proc.stderr.read, name="stream-decoder-stderr", daemon=True)
+        self._stderr.start()
+
+    def _read_stdout(self):
+        while True:
+            data = self._proc.stdout.read1(65536)
+            if not data:
+                break
+            with self._lock:
+                data = self._pending + data
+                n = len(data) // 4 * 4
+                self._pending = data[n:]
+                samples = np.frombuffer(data[:n], dtype=np.float32)
+                if self._length + len(samples) > len(self._pcm):
+                    # 容量を倍にして移す（追記の合計コストは録音長に比例）
+                    grown = np.zeros(max(2 * len(self._pcm), self._length + len(samples)), dtype=np.float32)
+                    grown[:self._length] = self._pcm[:self._length]
+                    self._pcm = grown
+                self._pcm[self._length:self._length + len(samples)] = samples
+                self._length += len(samples)
+
+    def feed(self, data):
+        """録音データの続き（MediaRecorder の断片など）を ffmpeg に渡す"""
+        self._proc.stdin.write(data)
+        self._proc.stdin.flush()
+
+    def pcm(self):
+        """ここまでにデコードできたPCMを返す（読み取り専用のビュー。以降の追記で内容は変わらない）"""
+        with self._lock:
+            view = self._pcm[:self._length]
+        view = view.view()
+        view.flags.writeable = False
+        return view
+
+    def finish(self, timeout=DECODER_QUEUE_TIMEOUT):
+        """入力を閉じて残りをデコードし、録音全体のPCMを返す"""
+        self._proc.stdin.close()
+        try:
+            self._proc.wait(timeout=timeout)
+        finally:
+            self.close()
+        self._reader.join(timeout=timeout)
+        return self.pcm().copy()
+
+    def close(self):
+        """ffmpeg プロセスを終了し、デコーダーの枠を返す（途中で破棄されたセッション用。何度呼んでもよい）"""
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        _release_slot()
+
+
+def decoder_stats():
+    """デコーダーの稼働状況（実行中・待機中・処理数・拒否数）を返す"""
+    with _stats_lock:
+        return dict(_stats, backend=DECODER_BACKEND, concurrency=DECODER_CONCURRENCY)
+
+
+__all__ = ["SAMPLE_RATE", "DecoderBusy", "StreamDecoder", "decode_audio", "decode_audio_async", "decoder_stats"]
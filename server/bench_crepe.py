@@ -0,0 +1,91 @@
+# -----------------------------------------------
+# CREPE の設定（モデル容量・フレーム間隔・Viterbi）ごとの精度/速度ベンチマーク
+# 固定の録音セットに対して、基準設定（full / 10ms / Viterbiあり）の判定結果と
+# 各設定の判定結果（rest / 音名）の一致率と、CREPE 1回あたりの処理時間を表示する
+# 使い方:
+#   python bench_crepe.py recordings/*.webm --tempo 120 --bar-count 2 \
+#       --configs tiny:10:1,small:10:1,medium:10:1,full:20:1,tiny:20:0
+# -----------------------------------------------
+import argparse
+import time
+
+from audio_io import SAMPLE_RATE, decode_audio
+from pitch_core import run_crepe, segment_pitch
+
+REFERENCE = {"capacity": "full", "step_size": 10, "viterbi": True}
+DEFAULT_CONFIGS = ",".join(
+    f"{capacity}:{step}:1"
+    for capacity in ("tiny", "small", "medium", "large", "full")
+    for step in (10, 20, 40)
+)
+
+
+# "容量:ステップ[ms]:Viterbi(0/1)" の文字列を設定の辞書に変換
+def parse_config(text):
+    capacity, step_size, viterbi = text.split(":")
+    return {"capacity": capacity, "step_size": int(step_size), "viterbi": viterbi == "1"}
+
+
+def config_name(config):
+    return f"{config['capacity']}:{config['step_size']}:{int(config['viterbi'])}"
+
+
+# CREPE を実行して判定結果のラベル列と処理時間を返す
+def run(y, config, tempo, bar_count):
+    started = time.perf_counter()
+    frequency, confidence = run_crepe(y, SAMPLE_RATE, config)
+    elapsed = time.perf_counter() - started
+    segments = segment_pitch(y, SAMPLE_RATE, frequency, confidence, tempo, bar_count)
+    return [seg["label"] for seg in segments], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CREPE latency / note-label agreement benchmark")
+    parser.add_argument("files", nargs="+", help="録音ファイル（webm / wav など）")
+    parser.add_argument("--tempo", type=float, default=120)
+    parser.add_argument("--bar-count", type=int, default=1)
+    parser.add_argument("--configs", default=DEFAULT_CONFIGS)
+    parser.add_argument("--repeat", type=int, default=3, help="処理時間を計測する回数（中央値を採用）")
+    args = parser.parse_args()
+
+    recordings = []
+    for path in args.files:
+        with open(path, "rb") as f:
+            recordings.append((path, decode_audio(f.read())))
+
+    # 基準設定のラベル（モデルの読み込み時間を含めないよう、先に1度実行しておく）
+    references = []
+    for _, y in recordings:
+        run(y, REFERENCE, args.tempo, args.bar_count)
+        labels, _ = run(y, REFERENCE, args.tempo, args.bar_count)
+        references.append(labels)
+
+    print(f"{'config':<16}{'latency (ms)':>14}{'agreement':>12}{'note agreement':>16}")
+    for text in args.configs.split(","):
+        config = parse_config(text)
+        run(recordings[0][1], config, args.tempo, args.bar_count)  # ウォームアップ
+
+        latencies = []
+        matched = total = note_matched = note_total = 0
+        for (_, y), reference in zip(recordings, references):
+            times = []
+            for _ in range(args.repeat):
+                labels, elapsed = run(y, config, args.tempo, args.bar_count)
+                times.append(elapsed)
+            latencies.append(sorted(times)[len(times) // 2])
+
+            for expected, actual in zip(reference, labels):
+                total += 1
+                matched += expected == actual
+                if expected != "rest":
+                    note_total += 1
+                    note_matched += expected == actual
+
+        latency_ms = sum(latencies) / len(latencies) * 1000
+        agreement = matched / total if total else 0.0
+        note_agreement = note_matched / note_total if note_total else 0.0
+        print(f"{config_name(config):<16}{latency_ms:>14.1f}{agreement:>12.1%}{note_agreement:>16.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# -----------------------------------------------
+# 特徴量エンジン（features.py）の一致確認とベンチマーク
+# 以前の librosa 個別呼び出し版（特徴量ごとにSTFTを計算）を基準として、
+# 推論（predict）・学習（train）両方のレイアウトについて出力差（許容誤差内か）を確かめ、
+# 1チャンクあたりの処理時間を比較する（pytest の test_features.py も同じ基準実装を使う）
+# 使い方: python bench_features.py [音声ファイル ...]
+# -----------------------------------------------
+import sys
+import time
+
+import numpy as np
+import librosa
+
+from features import HOP_LENGTH, compute_frames, pool_features
+
+SR = 16000
+RTOL = 1e-4
+ATOL = 1e-4
+
+
+# 基準実装: 以前の predict_api.extract_features（無音判定を除く）
+def reference_predict_features(y, sr):
+    rms = librosa.feature.rms(y=y)
+    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
+    width = min(5, mfccs.shape[1] // 2 * 2 + 1)
+    delta_mfccs = librosa.feature.delta(mfccs, width=width)
+    zcr = librosa.feature.zero_crossing_rate(y)
+    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
+    bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
+    flatness = librosa.feature.spectral_flatness(y=y)
+    rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
+    contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+
+    freqs = librosa.fft_frequencies(sr=sr)
+    S = np.abs(librosa.stft(y))
+    total_energy = np.mean(S)
+    high_energy_ratio = np.mean(S[freqs >= 4000, :]) / (total_energy + 1e-6)
+    low_energy_ratio = np.mean(S[freqs <= 250, :]) / (total_energy + 1e-6)
+    spectral_flux = np.sqrt(np.mean(np.diff(S, axis=1)**2))
+    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+
+    return np.concatenate([
+        np.mean(mfccs, axis=1), np.std(mfccs, axis=1),
+        np.mean(delta_mfccs, axis=1), np.std(delta_mfccs, axis=1),
+        np.mean(zcr, axis=1), np.std(zcr, axis=1),
+        np.mean(rms, axis=1), np.std(rms, axis=1),
+        np.mean(centroid, axis=1), np.std(centroid, axis=1),
+        np.mean(bandwidth, axis=1), np.std(bandwidth, axis=1),
+        np.mean(flatness, axis=1), np.std(flatness, axis=1),
+        np.mean(rolloff, axis=1), np.std(rolloff, axis=1),
+        np.mean(contrast, axis=1), np.std(contrast, axis=1),
+        np.array([spectral_flux]),
+        np.array([high_energy_ratio]),
+        np.mean(chroma, axis=1), np.std(chroma, axis=1),
+        np.array([low_energy_ratio]),
+    ])
+
+
+# 基準実装: 以前の train_model.extract_features_from_y（末尾10%のカットを除く）
+def reference_train_features(y, sr):
+    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
+    delta_mfccs = librosa.feature.delta(mfccs)
+    zcr = librosa.feature.zero_crossing_rate(y)
+    rms = librosa.feature.rms(y=y)
+    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
+    bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
+    flatness = librosa.feature.spectral_flatness(y=y)
+    rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
+    contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+
+    S = np.abs(librosa.stft(y))
+    spectral_flux = np.sqrt(np.mean(np.diff(S, axis=1)**2))
+    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+    freqs = librosa.fft_frequencies(sr=sr)
+    total_energy = np.mean(S)
+    high_energy_ratio = np.mean(S[freqs >= 4000, :]) / (total_energy + 1e-6)
+    low_energy_ratio = np.mean(S[freqs <= 250, :]) / (total_energy + 1e-6)
+
+    return np.concatenate([
+        np.mean(mfccs, axis=1), np.std(mfccs, axis=1),
+        np.mean(delta_mfccs, axis=1), np.std(delta_mfccs, axis=1),
+        np.mean(zcr, axis=1), np.std(zcr, axis=1),
+        np.mean(rms, axis=1), np.std(rms, axis=1),
+        np.mean(centroid, axis=1), np.std(centroid, axis=1),
+        np.mean(bandwidth, axis=1), np.std(bandwidth, axis=1),
+        np.mean(flatness, axis=1), np.std(flatness, axis=1),
+        np.mean(rolloff, axis=1), np.std(rolloff, axis=1),
+        np.mean(contrast, axis=1), np.std(contrast, axis=1),
+        np.array([high_energy_ratio]),
+        np.array([spectral_flux]),
+        np.array([low_energy_ratio]),
+        np.mean(chroma, axis=1), np.std(chroma, axis=1),
+    ])
+
+
+REFERENCES = {"predict": reference_predict_features, "train": reference_train_features}
+
+# 学習レイアウトの ΔMFCC（librosa.feature.delta の既定幅9）に必要な最小フレーム数
+TRAIN_MIN_FRAMES = 9
+
+
+def engine_predict_features(y, sr):
+    return pool_features(compute_frames(y, sr), layout="predict")
+
+
+def engine_features(y, sr, layout):
+    return pool_features(compute_frames(y, sr), layout=layout)
+
+
+# 音声ファイルが指定されなければ、キック/ハイハット風の合成音でチャンクを作る
+def load_chunks(paths):
+    if paths:
+        chunks = []
+        for path in paths:
+            y, _ = librosa.load(path, sr=SR)
+            chunks.append(y)
+        return chunks
+
+    rng = np.random.default_rng(0)
+    t = np.arange(int(SR * 0.225)) / SR
+    kick = np.sin(2 * np.pi * 60 * t) * np.exp(-t * 20)
+    hihat = rng.standard_normal(len(t)) * np.exp(-t * 60) * 0.3
+    voice = 0.2 * np.sin(2 * np.pi * 220 * t) + 0.01 * rng.standard_normal(len(t))
+    return [x.astype(np.float32) for x in (kick, hihat, voice)]
+
+
+def main():
+    chunks = load_chunks(sys.argv[1:])
+
+    worst = 0.0
+    all_ok = True
+    for layout, reference in REFERENCES.items():
+        for i, y in enumerate(chunks):
+            if layout == "train" and 1 + len(y) // HOP_LENGTH < TRAIN_MIN_FRAMES:
+                print(f"[{layout}] chunk {i}: skipped (shorter than {TRAIN_MIN_FRAMES} frames)")
+                continue
+            ref = reference(y, SR)
+            new = engine_features(y, SR, layout)
+            ok = np.allclose(new, ref, rtol=RTOL, atol=ATOL)
+            diff = float(np.max(np.abs(new - ref)))
+            worst = max(worst, diff)
+            all_ok = all_ok and ok
+            print(f"[{layout}] chunk {i}: max abs diff = {diff:.3e} {'OK' if ok else 'MISMATCH'}")
+            if not ok:
+                bad = np.flatnonzero(~np.isclose(new, ref, rtol=RTOL, atol=ATOL))
+                print(f"    mismatched dims: {bad.tolist()}")
+
+    for name, fn in (("reference", reference_predict_features), ("engine", engine_predict_features)):
+        fn(chunks[0], SR)  # ウォームアップ（numba のJITなど）
+        start = time.perf_counter()
+        repeats = 20
+        for _ in range(repeats):
+            for y in chunks:
+                fn(y, SR)
+        elapsed = (time.perf_counter() - start) / (repeats * len(chunks))
+        print(f"{name:>9}: {elapsed * 1000:.2f} ms / chunk")
+
+    print(f"worst max abs diff: {worst:.3e}")
+    return 0 if all_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# -----------------------------------------------
+# 負荷試験: Flask（gunicorn gthread, Dockerfile と同じ設定）と ASGI（uvicorn + asgi_app）の比較
+# 各サーバーを別プロセスで起動し、同時接続数 --concurrency で合計 --requests 回の POST を送り、
+# スループット（req/s）・レイテンシ（p50 / p95）・エラー数を表示する
+# --upload-kbps を指定すると、モバイル回線を想定してアップロードをその速度に絞って送る
+# 使い方: python bench_load.py [--endpoint /predict] [--file 音声ファイル] [--servers gthread,asgi]
+# -----------------------------------------------
+import argparse
+import http.client
+import os
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+from bench_startup import encode_multipart, make_test_wav, wait_for_health
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Dockerfile の CMD と同じ起動設定
+SERVERS = {
+    "gthread": ["gunicorn", "-b", "127.0.0.1:{port}", "-w", "1", "-k", "gthread", "--threads", "8", "--timeout", "300", "main_api:app"],
+    "asgi": ["uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", "{port}", "--timeout-keep-alive", "300"],
+}
+
+
+# 1リクエストを送り、(成功したか, 所要時間[s]) を返す
+def send(port, endpoint, body, content_type, upload_kbps, timeout):
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.putrequest("POST", endpoint)
+        conn.putheader("Content-Type", content_type)
+        conn.putheader("Content-Length", str(len(body)))
+        conn.endheaders()
+        if upload_kbps > 0:
+            # 0.1秒ごとに回線速度ぶんずつ送る
+            step = max(1, int(upload_kbps * 1000 / 8 * 0.1))
+            for i in range(0, len(body), step):
+                conn.send(body[i:i + step])
+                time.sleep(0.1)
+        else:
+            conn.send(body)
+        res = conn.getresponse()
+        res.read()
+        return res.status == 200, time.perf_counter() - started
+    except (OSError, http.client.HTTPException):
+        return False, time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def run_load(port, endpoint, body, content_type, args):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = [args.requests]
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            ok, elapsed = send(port, endpoint, body, content_type, args.upload_kbps, args.timeout)
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    return args.requests / wall, np.percentile(latencies, 50), np.percentile(latencies, 95), errors
+
+
+def bench_server(name, endpoint, body, content_type, args):
+    command = [part.format(port=args.port) for part in SERVERS[name]]
+    env = dict(os.environ)
+    env.setdefault("MODEL_LOAD_POLICY", "eager")
+    proc = subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_health(f"http://127.0.0.1:{args.port}", time.perf_counter(), args.timeout)
+        # ウォームアップ（初回リクエストの読み込み時間を計測に含めない）
+        send(args.port, endpoint, body, content_type, 0, args.timeout)
+        return run_load(args.port, endpoint, body, content_type, args)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gunicorn gthread vs uvicorn ASGI load test")
+    parser.add_argument("--endpoint", default="/predict")
+    parser.add_argument("--file", help="送信する音声ファイル（省略時はクリック音を生成）")
+    parser.add_argument("--servers", default="gthread,asgi")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--upload-kbps", type=float, default=0, help="アップロード速度の上限（0 で無制限）")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            file_bytes = f.read()
+        filename = os.path.basename(args.file)
+    else:
+        file_bytes, filename = make_test_wav(bar_count=2), "bench.wav"
+    body, content_type = encode_multipart({"tempo": 120, "bar_count": 2}, file_bytes, filename)
+
+    # 同じ音声を繰り返し送るため、結果キャッシュと中間結果の保持を無効にして毎回解析させる
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+    os.environ.setdefault("ANALYSIS_STORE_SIZE", "0")
+
+    print(f"{args.endpoint}  requests={args.requests}  concurrency={args.concurrency}  upload_kbps={args.upload_kbps or 'unlimited'}")
+    print(f"{'server':<10}{'req/s':>10}{'p50 (s)':>10}{'p95 (s)':>10}{'errors':>8}")
+    for name in args.servers.split(","):
+        throughput, p50, p95, errors = bench_server(name, args.endpoint, body, content_type, args)
+        print(f"{name:<10}{throughput:>10.2f}{p50:>10.2f}{p95:>10.2f}{errors:>8}")
+
+
+if __name__ == "__main__":
+    main()
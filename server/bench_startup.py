@@ -0,0 +1,125 @@
+# -----------------------------------------------
+# サーバー起動時間のベンチマーク
+# main_api を別プロセスで起動し、以下の時間を MODEL_LOAD_POLICY ごとに計測する
+# ・プロセス起動から /health が 200 を返すまで
+# ・プロセス起動から最初の /predict が 200 を返すまで
+# 使い方: python bench_startup.py [--file 音声ファイル] [--policies eager,lazy,background]
+# -----------------------------------------------
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+import wave
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# テスト用の音声（1小節分のクリック音）を WAV バイト列として生成
+def make_test_wav(tempo=120, bar_count=1, sr=16000):
+    duration = 60.0 / tempo * 4 * bar_count
+    y = np.zeros(int(sr * duration), dtype=np.float32)
+    t = np.arange(int(sr * 0.05)) / sr
+    click = 0.5 * np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 80)
+    for i in range(8 * bar_count):
+        start = int(sr * i * duration / (8 * bar_count))
+        y[start:start + len(click)] += click[:len(y) - start]
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes((np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes())
+    return buf.getvalue()
+
+
+# multipart/form-data のリクエストボディを組み立てる
+def encode_multipart(fields, file_bytes, filename):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n".encode()
+        )
+    parts.append(
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: application/octet-stream\r\n\r\n".encode() + file_bytes + b"\r\n"
+    )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def wait_for_health(base_url, started, timeout):
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=1) as res:
+                if res.status == 200:
+                    return time.perf_counter() - started
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.05)
+    raise TimeoutError("/health did not respond in time")
+
+
+def first_predict(base_url, started, file_bytes, filename, timeout):
+    body, content_type = encode_multipart({"tempo": 120, "bar_count": 1}, file_bytes, filename)
+    req = urllib.request.Request(f"{base_url}/predict", data=body, headers={"Content-Type": content_type})
+    with urllib.request.urlopen(req, timeout=timeout) as res:
+        payload = json.loads(res.read())
+    if "segments" not in payload:
+        raise RuntimeError(f"unexpected /predict response: {payload}")
+    return time.perf_counter() - started
+
+
+def run_once(policy, port, file_bytes, filename, timeout):
+    env = dict(os.environ, PORT=str(port), MODEL_LOAD_POLICY=policy)
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "main_api.py"], cwd=BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        health = wait_for_health(base_url, started, timeout)
+        predict = first_predict(base_url, started, file_bytes, filename, timeout)
+        return health, predict
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time-to-first-/health and time-to-first-/predict")
+    parser.add_argument("--file", help="/predict に送る音声ファイル（省略時はクリック音を生成）")
+    parser.add_argument("--policies", default="eager,lazy,background")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            file_bytes = f.read()
+        filename = os.path.basename(args.file)
+    else:
+        file_bytes, filename = make_test_wav(), "bench.wav"
+
+    print(f"{'policy':<12}{'health (s)':>12}{'predict (s)':>14}")
+    for policy in args.policies.split(","):
+        for _ in range(args.repeat):
+            health, predict = run_once(policy, args.port, file_bytes, filename, args.timeout)
+            print(f"{policy:<12}{health:>12.2f}{predict:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
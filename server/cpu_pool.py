@@ -0,0 +1,179 @@
+# -----------------------------------------------
+# CPU 処理（librosa の特徴量抽出・CREPE と音高判定）を別プロセスで実行するプロセスプール
+# gunicorn gthread のスレッドは GIL で Python コードの実行が直列化されるため、
+# 重い処理をワーカープロセスに渡し、コア数に応じて並列に実行できるようにする
+# ・CPU_POOL_WORKERS: ワーカープロセス数（0 でプールを使わず、リクエストのスレッドで実行する）
+# ・CPU_POOL_STAGES: プールで実行する処理（rhythm = 特徴量抽出、pitch = CREPE と音高判定）
+# ワーカーは起動時に librosa とメルフィルタバンク等を読み込み、pitch を担当する場合は CREPE モデルも読み込む
+# PCM はリクエストごとに共有メモリに置き、ワーカーには共有メモリの名前だけを渡す（配列を pickle しない）
+# リズム分類器の推論は、マイクロバッチ・キューでまとめるためリクエスト側のプロセスで行う
+# ワーカーが読み込むのは Blueprint を持たない rhythm_core / pitch_core / features だけ（Flask やキャッシュは読み込まない）
+# ワーカーが異常終了（OOM・TF/CREPE 内のクラッシュ）してプールが壊れた場合は、プールを作り直して1度だけ再実行する
+# -----------------------------------------------
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", 0))
+CPU_POOL_STAGES = set(os.getenv("CPU_POOL_STAGES", "rhythm,pitch").split(","))
+
+# ワーカーもこのモジュールを読み込むため log_config は使わない（サーバー本体では log_config の設定で出力される）
+logger = logging.getLogger(f"micrie.{__name__}")
+
+
+# ワーカープロセスの初期化: 重いライブラリとフィルタバンク（lru_cache）、必要ならモデルを先に読み込む
+def _init_worker(stages):
+    from audio_io import SAMPLE_RATE
+    from features import compute_frames
+
+    compute_frames(np.random.default_rng(0).standard_normal(SAMPLE_RATE).astype(np.float32), SAMPLE_RATE)
+    if "pitch" in stages:
+        from pitch_core import crepe_config, run_crepe
+
+        run_crepe(np.zeros(SAMPLE_RATE, dtype=np.float32), SAMPLE_RATE, crepe_config())
+
+
+# ワーカー側: 共有メモリ上のPCMを配列として開き、func(y, *args) を実行する
+def _call_with_shared(func, name, shape, dtype, args):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        y = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = func(y, *args)
+        del y  # 共有メモリを閉じる前に参照を外す
+        return result
+    finally:
+        shm.close()
+
+
+# プールで実行するリズムの特徴量抽出（FEATURE_MODE=whole の場合は録音全体の STFT もワーカーで計算する）
+def rhythm_features_task(y, sr, tempo, bar_count, feature_mode, onsets=None):
+    from features import compute_frames
+    from rhythm_core import chunk_feature_rows
+
+    full_frames = compute_frames(y, sr) if feature_mode == "whole" else None
+    return chunk_feature_rows(y, sr, tempo, bar_count, full_frames, onsets)
+
+
+# プールで実行する CREPE（足りないフレームのみ）と音高判定
+def pitch_task(y, sr, config, tempo, bar_count, frames):
+    from pitch_core import crepe_frames, segment_pitch
+
+    frames = crepe_frames(y, sr, config, tempo, bar_count, frames)
+    return frames, segment_pitch(y, sr, frames["frequency"], frames["confidence"], tempo, bar_count)
+
+
+class CpuPool:
+    """共有メモリでPCMを渡すプロセスプール（初回利用時にワーカーを起動する）"""
+
+    def __init__(self, workers=0, stages=("rhythm", "pitch")):
+        self.workers = max(0, int(workers))
+        self.stages = set(stages)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._broken = 0
+        self._restarts = 0
+        self._in_flight = 0
+
+    def runs(self, stage):
+        """その処理をプールで実行するかどうか"""
+        return self.workers > 0 and stage in self.stages
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # fork だと TensorFlow / スレッドの状態を引き継いでしまうため spawn で起動する
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_worker,
+                        initargs=(self.stages,),
+                    )
+        return self._executor
+
+    # 壊れたプールを破棄する（次の _get_executor で新しいプールを起動する）
+    # 同時に失敗した他のリクエストが、既に作り直したプールを破棄しないよう、壊れたものと同じ場合だけ外す
+    def _reset_executor(self, broken):
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        with self._stats_lock:
+            self._restarts += 1
+        logger.warning("♻️ プロセスプールのワーカーが異常終了したため、プールを作り直します")
+
+    def _submit(self, func, shm, y, args):
+        executor = self._get_executor()
+        try:
+            return executor.submit(_call_with_shared, func, shm.name, y.shape, y.dtype.str, args).result()
+        except BrokenProcessPool:
+            with self._stats_lock:
+                self._broken += 1
+            self._reset_executor(executor)
+            raise
+
+    def run(self, func, y, *args):
+        """func(y, *args) をワーカーで実行して結果を返す（y は共有メモリ経由で渡す）"""
+        y = np.ascontiguousarray(y)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, y.nbytes))
+        with self._stats_lock:
+            self._submitted += 1
+            self._in_flight += 1
+        try:
+            np.ndarray(y.shape, dtype=y.dtype, buffer=shm.buf)[:] = y
+            try:
+                result = self._submit(func, shm, y, args)
+            except BrokenProcessPool:
+                # ワーカーが異常終了した（このリクエストが原因とは限らない）。新しいプールで1度だけ再実行する
+                result = self._submit(func, shm, y, args)
+            with self._stats_lock:
+                self._completed += 1
+            return result
+        except Exception:
+            with self._stats_lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+            shm.close()
+            shm.unlink()
+
+    def warmup(self):
+        """全ワーカーを起動して初期化を済ませる（起動時のウォームアップ用）"""
+        if self.workers == 0:
+            return
+        executor = self._get_executor()
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def stats(self):
+        """ワーカー数と処理数（投入・完了・失敗・実行中）、プールが壊れた回数・作り直した回数を返す"""
+        with self._stats_lock:
+            return {
+                "workers": self.workers,
+                "stages": sorted(self.stages) if self.workers else [],
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "broken": self._broken,
+                "restarts": self._restarts,
+                "in_flight": self._in_flight,
+            }
+
+
+# アプリ全体で共有するプロセスプール
+cpu_pool = CpuPool(CPU_POOL_WORKERS, CPU_POOL_STAGES)
+
+__all__ = ["CPU_POOL_WORKERS", "CpuPool", "cpu_pool", "pitch_task", "rhythm_features_task"]
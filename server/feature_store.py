@@ -0,0 +1,111 @@
+# -----------------------------------------------
+# 学習データの特徴量ストア（追記専用・メモリマップ）
+# 特徴ベクトルを float32 の行列としてファイル（features.f32）に追記し、
+# どのファイルの何行目からがどの音声・ラベルかを索引（index.jsonl）に1行ずつ追記する
+# ・学習時は行列を np.memmap で開くため、データセット全体をメモリに載せずに読める
+# ・追記の途中で中断しても、索引に記録済みの範囲だけを有効とし（途中の行や行列の末尾は開くときに切り詰める）、
+#   再実行で続きから抽出できる
+# -----------------------------------------------
+import json
+import os
+import threading
+
+import numpy as np
+
+from features import FEATURE_DIM
+
+FEATURES_FILE = "features.f32"
+INDEX_FILE = "index.jsonl"
+
+
+class FeatureStore:
+    """キー（音声ファイルのハッシュ等）ごとに特徴ベクトルの行を追記していく行列ストア"""
+
+    def __init__(self, directory, dim=FEATURE_DIM):
+        self.directory = directory
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._rows = 0
+        os.makedirs(directory, exist_ok=True)
+        self._features_path = os.path.join(directory, FEATURES_FILE)
+        self._index_path = os.path.join(directory, INDEX_FILE)
+        self._load_index()
+
+    def _load_index(self):
+        # 索引は改行まで書き終えた行だけを有効とし、書き込み途中で中断した末尾の行は切り詰める
+        # （残したままだと次の追記がその断片に続いて書かれ、以降の行がすべて読めなくなる）
+        valid_bytes = 0
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    self._entries[entry["key"]] = entry
+                    self._rows = max(self._rows, entry["offset"] + entry["rows"])
+                    valid_bytes += len(line)
+        with open(self._index_path, "ab") as f:
+            if f.tell() != valid_bytes:
+                f.truncate(valid_bytes)
+        # 索引に記録される前に中断した行列の末尾を切り詰める
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        with open(self._features_path, "ab") as f:
+            if f.tell() != self._rows * row_bytes:
+                f.truncate(self._rows * row_bytes)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return self._rows
+
+    def append(self, key, label, rows, **info):
+        """1音声分の特徴ベクトル (行数, dim) を追記し、索引に記録する"""
+        rows = np.asarray(rows, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            if key in self._entries:
+                return
+            with open(self._features_path, "ab") as f:
+                f.write(rows.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            entry = {"key": key, "label": int(label), "offset": self._rows, "rows": len(rows), **info}
+            # 行列を書き終えてから索引に記録する（索引にある範囲は常に書き込み済み）
+            with open(self._index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._entries[key] = entry
+            self._rows += len(rows)
+
+    def matrix(self):
+        """全特徴ベクトルを (行数, dim) の読み取り専用メモリマップとして返す（コピーしない）"""
+        if self._rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self._features_path, dtype=np.float32, mode="r", shape=(self._rows, self.dim))
+
+    def select(self, keys):
+        """指定したキーの行番号とラベルを返す（今のデータセットにある音声だけで学習するため）"""
+        indices, labels = [], []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            indices.append(np.arange(entry["offset"], entry["offset"] + entry["rows"]))
+            labels.append(np.full(entry["rows"], entry["label"]))
+        if not indices:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(indices), np.concatenate(labels)
+
+    def stats(self):
+        """登録済みの音声数・行数・ファイルサイズを返す"""
+        return {
+            "entries": len(self._entries),
+            "rows": self._rows,
+            "bytes": self._rows * self.dim * np.dtype(np.float32).itemsize,
+        }
+
+
+__all__ = ["FeatureStore"]
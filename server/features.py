@@ -0,0 +1,164 @@
+# -----------------------------------------------
+# リズム分類用の特徴量エンジン
+# 1回のSTFTで得た振幅/パワースペクトログラムとメルフィルタバンクから
+# MFCC・スペクトル系・クロマなど全105次元の特徴量をまとめて計算する
+# compute_frames でフレーム単位の特徴量を求め、pool_features で平均・標準偏差に集約
+# 録音全体を1度だけ compute_frames し、frame_range でチャンクごとのフレーム範囲を集約することもできる
+# -----------------------------------------------
+from functools import lru_cache
+
+import numpy as np
+import librosa
+
+N_FFT = 2048
+HOP_LENGTH = 512
+FEATURE_DIM = 105
+
+# 推論（predict_api）と学習（train_model）で特徴量の並び順が異なるため、レイアウトとして区別する
+LAYOUTS = ("predict", "train")
+
+
+# メルフィルタバンクとクロマフィルタバンクはサンプリングレートごとに1度だけ作る
+@lru_cache(maxsize=8)
+def _mel_basis(sr, n_fft):
+    return librosa.filters.mel(sr=sr, n_fft=n_fft)
+
+
+@lru_cache(maxsize=64)
+def _chroma_basis(sr, n_fft, tuning):
+    return librosa.filters.chroma(sr=sr, n_fft=n_fft, tuning=tuning)
+
+
+@lru_cache(maxsize=8)
+def _fft_frequencies(sr, n_fft):
+    return librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+
+
+def compute_frames(y, sr, rms=None):
+    """1回のSTFTからフレーム単位の特徴量をすべて計算して辞書で返す"""
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    power = S ** 2
+
+    # メルスペクトログラム → MFCC（librosa.feature.mfcc と同じ処理をSTFTを共有して行う）
+    mel = np.einsum("...ft,mf->...mt", power, _mel_basis(sr, N_FFT), optimize=True)
+    mfccs = librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=13)
+
+    # 時間領域の特徴量（STFT不要）
+    if rms is None:
+        rms = librosa.feature.rms(y=y, frame_length=N_FFT, hop_length=HOP_LENGTH)
+    zcr = librosa.feature.zero_crossing_rate(y, frame_length=N_FFT, hop_length=HOP_LENGTH)
+
+    # スペクトル系の特徴量は振幅スペクトログラムを使い回す
+    centroid = librosa.feature.spectral_centroid(S=S, sr=sr)
+    bandwidth = librosa.feature.spectral_bandwidth(S=S, sr=sr, centroid=centroid)
+    flatness = librosa.feature.spectral_flatness(S=S)
+    rolloff = librosa.feature.spectral_rolloff(S=S, sr=sr)
+    contrast = librosa.feature.spectral_contrast(S=S, sr=sr)
+
+    # クロマ: librosa.feature.chroma_stft と同じくパワースペクトログラムからチューニングを推定
+    tuning = float(librosa.estimate_tuning(S=power, sr=sr, bins_per_octave=12))
+    raw_chroma = np.einsum("cf,...ft->...ct", _chroma_basis(sr, N_FFT, tuning), power, optimize=True)
+    chroma = librosa.util.normalize(raw_chroma, norm=np.inf, axis=-2)
+
+    return {
+        "S": S,
+        "freqs": _fft_frequencies(sr, N_FFT),
+        "mfcc": mfccs,
+        "zcr": zcr,
+        "rms": rms,
+        "centroid": centroid,
+        "bandwidth": bandwidth,
+        "flatness": flatness,
+        "rolloff": rolloff,
+        "contrast": contrast,
+        "chroma": chroma,
+    }
+
+
+def onset_times(y, sr, frames=None):
+    """librosa.onset.onset_detect(backtrack=True) と同じオンセット時刻[s]を返す
+
+    frames（compute_frames の結果）を渡すと、その STFT からオンセット強度を計算する（STFT をやり直さない）
+    """
+    S = frames["S"] if frames is not None else np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    # librosa.onset.onset_strength と同じく、対数メルスペクトログラムの正の差分から強度を求める
+    mel = np.einsum("...ft,mf->...mt", S ** 2, _mel_basis(sr, N_FFT), optimize=True)
+    envelope = librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=sr, hop_length=HOP_LENGTH)
+    onset_frames = librosa.onset.onset_detect(onset_envelope=envelope, sr=sr, hop_length=HOP_LENGTH, backtrack=True)
+    return np.sort(librosa.frames_to_time(onset_frames, sr=sr, hop_length=HOP_LENGTH))
+
+
+def snap_to_onsets(onsets, chunk_duration, n_chunks):
+    """各チャンクの開始時刻を、開始時刻の半チャンク前から開始時刻までにある最後のオンセットにずらす
+
+    （search_start <= onset < chunk_start を満たすオンセットがなければ元の開始時刻のまま）
+    """
+    starts = np.arange(n_chunks) * chunk_duration
+    # 各チャンクの開始時刻より前にある最後のオンセット
+    last = np.searchsorted(onsets, starts, side="left") - 1
+    candidates = np.asarray(onsets, dtype=float)[np.maximum(last, 0)] if len(onsets) else starts
+    snapped = (last >= 0) & (candidates >= starts - 0.5 * chunk_duration)
+    return np.where(snapped, candidates, starts)
+
+
+def frame_range(start_sample, end_sample, n_frames, min_frames=2):
+    """サンプル範囲 [start_sample, end_sample) に中心が入るフレーム範囲 [start, end) を返す"""
+    start = min(-(-start_sample // HOP_LENGTH), n_frames)
+    end = min(-(-end_sample // HOP_LENGTH), n_frames)
+    # 平均・標準偏差・フラックスが計算できるよう最低フレーム数を確保
+    if end - start < min_frames:
+        end = min(start + min_frames, n_frames)
+        start = max(0, end - min_frames)
+    return start, end
+
+
+def pool_features(frames, start=0, end=None, layout="predict"):
+    """フレーム範囲 [start, end) の特徴量を平均・標準偏差に集約し、105次元ベクトルにする"""
+    if layout not in LAYOUTS:
+        raise ValueError(f"unknown feature layout: {layout}")
+
+    def part(name):
+        return frames[name][:, start:end]
+
+    mfccs = part("mfcc")
+    if layout == "predict":
+        width = min(5, mfccs.shape[1] // 2 * 2 + 1)
+        delta_mfccs = librosa.feature.delta(mfccs, width=width)
+    else:
+        delta_mfccs = librosa.feature.delta(mfccs)
+
+    # スペクトルフラックスと高域/低域エネルギー比
+    S = part("S")
+    freqs = frames["freqs"]
+    spectral_flux = np.sqrt(np.mean(np.diff(S, axis=1) ** 2))
+    total_energy = np.mean(S)
+    high_energy_ratio = np.mean(S[freqs >= 4000, :]) / (total_energy + 1e-6)
+    low_energy_ratio = np.mean(S[freqs <= 250, :]) / (total_energy + 1e-6)
+
+    stats = []
+    for x in (mfccs, delta_mfccs, part("zcr"), part("rms"), part("centroid"), part("bandwidth"),
+              part("flatness"), part("rolloff"), part("contrast")):
+        stats.append(np.mean(x, axis=1))
+        stats.append(np.std(x, axis=1))
+
+    chroma = part("chroma")
+    if layout == "predict":
+        tail = [
+            np.array([spectral_flux]),
+            np.array([high_energy_ratio]),
+            np.mean(chroma, axis=1),
+            np.std(chroma, axis=1),
+            np.array([low_energy_ratio]),
+        ]
+    else:
+        tail = [
+            np.array([high_energy_ratio]),
+            np.array([spectral_flux]),
+            np.array([low_energy_ratio]),
+            np.mean(chroma, axis=1),
+            np.std(chroma, axis=1),
+        ]
+    return np.concatenate(stats + tail)
+
+
+__all__ = ["FEATURE_DIM", "HOP_LENGTH", "N_FFT", "compute_frames", "frame_range", "onset_times", "pool_features", "snap_to_onsets"]
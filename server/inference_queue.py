@@ -0,0 +1,167 @@
+# -----------------------------------------------
+# 複数リクエストの特徴ベクトルをまとめて推論するマイクロバッチ・キュー
+# 同時に届いた行を一定時間（例: 5ms）または一定行数（例: 256行）まで集め、
+# 1回の model.predict で推論して、各リクエストに自分の行のスコアを返す
+# ・先頭の依頼の時点で他に待っている依頼がなければ、ウィンドウを待たずにすぐ推論する
+#   （単発のリクエストに待ち時間を足さない。推論中に届いた依頼が次のバッチにまとまる）
+# ・バッチの推論が失敗した場合は依頼ごとに推論し直し、失敗した依頼だけに例外を返す
+# キューの深さやバッチサイズのカウンタを stats() で参照できる
+# -----------------------------------------------
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+# キューに積まれる1リクエスト分の推論依頼
+class _InferenceRequest:
+    __slots__ = ("rows", "done", "result", "error")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """同時リクエストの行をまとめて1回の順伝播で推論するキュー"""
+
+    def __init__(self, get_model, window_ms=5.0, max_rows=256):
+        # get_model はモデルを返す関数（初回推論時まで読み込みを遅らせられるように関数で受け取る）
+        self._get_model = get_model
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.max_rows = max(1, int(max_rows))
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._queue_depth = 0        # 推論待ちの行数
+        self._max_queue_depth = 0
+        self._requests = 0
+        self._rows = 0
+        self._batches = 0
+        self._last_batch_size = 0
+        self._max_batch_size = 0
+
+    def predict(self, rows):
+        """(N, D) の特徴行列を推論し、(N, クラス数) のスコアを返す"""
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+
+        # ウィンドウ0ならバッチ化せず、呼び出し元スレッドでそのまま推論
+        if self.window == 0:
+            self._record_enqueue(len(rows))
+            self._record_dequeue(len(rows))
+            scores = self._get_model().predict(rows)
+            self._record_batch(len(rows))
+            return scores
+
+        self._ensure_worker()
+        req = _InferenceRequest(rows)
+        self._record_enqueue(len(rows))
+        self._queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def stats(self):
+        """チューニング用のカウンタを辞書で返す"""
+        with self._stats_lock:
+            return {
+                "window_ms": self.window * 1000.0,
+                "max_rows": self.max_rows,
+                "queue_depth": self._queue_depth,
+                "max_queue_depth": self._max_queue_depth,
+                "requests": self._requests,
+                "rows": self._rows,
+                "batches": self._batches,
+                "last_batch_size": self._last_batch_size,
+                "max_batch_size": self._max_batch_size,
+                "mean_batch_size": (self._rows / self._batches) if self._batches else 0.0,
+            }
+
+    # 推論用のワーカースレッドを初回利用時に起動
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    # 先頭の依頼を受け取ってからウィンドウ時間内に届いた依頼を、最大行数まで束ねて推論する
+    # 先頭の依頼の時点でキューが空なら、他に束ねる相手がいないのでウィンドウを待たない
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            n_rows = len(batch[0].rows)
+            deadline = time.monotonic() + self.window
+            while n_rows < self.max_rows and not (len(batch) == 1 and self._queue.empty()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(req)
+                n_rows += len(req.rows)
+            self._run_batch(batch, n_rows)
+
+    def _run_batch(self, batch, n_rows):
+        self._record_dequeue(n_rows)
+        try:
+            scores = self._get_model().predict(np.concatenate([req.rows for req in batch], axis=0))
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+                batch[0].done.set()
+                return
+            # 1つの不正な依頼でまとめた全員を失敗させないよう、依頼ごとに推論し直す
+            for req in batch:
+                self._run_single(req)
+            return
+
+        self._record_batch(n_rows)
+        # 各リクエストに自分の行範囲のスコアを返す
+        offset = 0
+        for req in batch:
+            req.result = scores[offset:offset + len(req.rows)]
+            offset += len(req.rows)
+            req.done.set()
+
+    # 1件の依頼だけを推論し、結果か例外をその依頼に返す
+    def _run_single(self, req):
+        try:
+            req.result = self._get_model().predict(req.rows)
+        except Exception as e:
+            req.error = e
+        else:
+            self._record_batch(len(req.rows))
+        req.done.set()
+
+    def _record_enqueue(self, n_rows):
+        with self._stats_lock:
+            self._requests += 1
+            self._queue_depth += n_rows
+            self._max_queue_depth = max(self._max_queue_depth, self._queue_depth)
+
+    def _record_dequeue(self, n_rows):
+        with self._stats_lock:
+            self._queue_depth -= n_rows
+
+    def _record_batch(self, n_rows):
+        with self._stats_lock:
+            self._batches += 1
+            self._rows += n_rows
+            self._last_batch_size = n_rows
+            self._max_batch_size = max(self._max_batch_size, n_rows)
+
+
+__all__ = ["MicroBatcher"]
@@ -0,0 +1,64 @@
+# -----------------------------------------------
+# サーバー共通のロガー設定
+# ・各モジュールは get_logger(__name__) で "micrie.<モジュール名>" のロガーを使う
+# ・ログはキュー（QueueHandler）に積むだけで返り、標準出力への書き込みは QueueListener のスレッドが行う
+#   （リクエストのスレッドがコンソール出力で待たされない）
+# ・LOG_LEVEL: 出力するレベル（既定 INFO。DEBUG にするとチャンクごとの詳細も出力する）
+# ・LOG_DEBUG_SAMPLE: INFO のままでも、この割合（0〜1）のリクエストだけチャンクごとの詳細を出力する
+# -----------------------------------------------
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.INFO
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", 0))
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+# 抽出されたリクエストの詳細ログに付ける extra（LOG_LEVEL より低いレベルでも出力される）
+SAMPLED = {"sampled": True}
+
+
+# LOG_LEVEL 以上のログと、抽出されたリクエストの詳細ログだけをキューに積むフィルタ
+class _LevelOrSampled(logging.Filter):
+    def filter(self, record):
+        return record.levelno >= LOG_LEVEL or getattr(record, "sampled", False)
+
+
+def _setup():
+    root = logging.getLogger("micrie")
+    if root.handlers:
+        return root
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(_LevelOrSampled())
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # 終了時にキューに残ったログを書き出す
+    root.addHandler(queue_handler)
+    root.setLevel(logging.DEBUG if LOG_DEBUG_SAMPLE > 0 else LOG_LEVEL)
+    root.propagate = False
+    return root
+
+
+_setup()
+
+
+def get_logger(name):
+    """"micrie.<name>" のロガーを返す"""
+    return logging.getLogger(f"micrie.{name}")
+
+
+def sample_debug():
+    """このリクエストでチャンクごとの詳細ログを出すか（LOG_LEVEL=DEBUG なら常に、それ以外は LOG_DEBUG_SAMPLE の割合）"""
+    return LOG_LEVEL <= logging.DEBUG or (LOG_DEBUG_SAMPLE > 0 and random.random() < LOG_DEBUG_SAMPLE)
+
+
+__all__ = ["LOG_LEVEL", "SAMPLED", "get_logger", "sample_debug"]
@@ -1,37 +1,27 @@
 # -----------------------------------------------
 # Flask アプリケーションのエントリーポイント
-# Whisper, Predict, Pitch 各APIを Blueprint として登録し、
+# Whisper, Predict, Pitch, Stream, Multi 各APIを Blueprint として登録し、
 # CORSを有効化したうえでサーバーを起動
 # -----------------------------------------------
 
 # FlaskおよびCORSモジュール、各API Blueprint をインポート
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from whisper_api import whisper_bp
-from predict_api import predict_bp
+from predict_api import predict_bp, batcher
 from pitch_api import pitch_bp
+from stream_api import stream_bp, stream_stats
+from multi_api import multi_bp
+from audio_io import decoder_stats
+from cpu_pool import cpu_pool
+from prediction_log import prediction_log
+from metrics import begin_request, end_request, render_metrics
+from model_registry import MODEL_LOAD_POLICY, models
+from result_cache import analysis_store, result_cache
 
 import os
 import re
 
-# ----- Server-side Keras model (always enabled, lazy-loaded) -----
-from pathlib import Path
-import tensorflow as tf
-
-BASE_DIR = Path(__file__).resolve().parent
-MODEL_FILE = os.getenv("MODEL_FILE", "micrie_model.keras")
-MODEL_PATH = BASE_DIR / "model" / MODEL_FILE
-
-_model = None  # 初回アクセス時に読み込む（遅延ロード）
-def get_model():
-    global _model
-    if _model is None:
-        print(f"📦 モデル読み込み中: {MODEL_PATH}")
-        _model = tf.keras.models.load_model(str(MODEL_PATH))
-        print("✅ モデル読み込み完了")
-    return _model
-
-
 # Allow only local dev and Vercel origins (Preview + Production). If you have a fixed
 # production domain (e.g., https://micrie.vercel.app), set it via ENV `PROD_ORIGIN`.
 app = Flask(__name__)
@@ -49,31 +39,81 @@ CORS(
         "origins": allowed_origins,
         "methods": ["GET", "POST", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
-        "expose_headers": ["Content-Type"],
+        "expose_headers": ["Content-Type", "Server-Timing"],
         "supports_credentials": False,
         "max_age": 86400
     }}
 )
 
-app.config["GET_MODEL"] = get_model
+app.config["GET_MODEL"] = lambda: models.get("rhythm")
 
 app.register_blueprint(whisper_bp)  # Whisper API（音声認識）を登録
 app.register_blueprint(predict_bp)  # Predict API（音声分類）を登録
 app.register_blueprint(pitch_bp)    # Pitch API（音高推定）を登録
+app.register_blueprint(stream_bp)   # Stream API（録音中のストリーミング解析）を登録
+app.register_blueprint(multi_bp)    # Multi API（リズム・音高・Whisper の一括解析）を登録
+
+# MODEL_LOAD_POLICY=eager なら起動時に全モデル（Keras / Whisper / CREPE）を読み込む
+# background なら /health をすぐに返せるよう、別スレッドで読み込みとウォームアップを行う
+# （各Blueprintは TensorFlow / torch / crepe を初回利用時までインポートしない）
+# eager の場合は CPU_POOL_WORKERS のワーカープロセスも起動時に立ち上げておく
+# （CREPE をプロセスプールに任せる場合、CREPE はワーカーが読み込むため本体では起動時に読み込まない）
+# （プロセスプールのワーカーは spawn で起動し、このモジュールを __mp_main__ として再インポートするため、
+#   読み込みとウォームアップはサーバー本体のプロセスでだけ行う）
+if __name__ != "__mp_main__":
+    if MODEL_LOAD_POLICY == "eager":
+        models.load_all()
+        cpu_pool.warmup()
+    elif MODEL_LOAD_POLICY == "background":
+        models.warmup_in_background()
+
+# リクエストごとの処理時間の計測（エンドポイントはルールのパターン、bar_count はフォームの値でラベル付けする）
+@app.before_request
+def start_timer():
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    bar_count = request.form.get("bar_count", "") if request.mimetype == "multipart/form-data" else ""
+    request.environ["micrie.timer"] = begin_request(endpoint, bar_count)
+
+@app.after_request
+def finish_timer(response):
+    timer = request.environ.pop("micrie.timer", None)
+    if timer is not None:
+        server_timing = end_request(timer, response.status_code)
+        if server_timing:
+            response.headers["Server-Timing"] = server_timing
+    return response
+
+# 段階ごと・リクエストごとの処理時間のヒストグラム（Prometheus 形式）
+@app.get("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 # Health check endpoint
 @app.get("/health")
 def health():
     return jsonify({"ok": True})
 
+# 推論キュー・デコーダー・結果キャッシュ・プロセスプールのカウンタ（バッチウィンドウや同時実行数のチューニング用）
+@app.get("/stats")
+def stats():
+    return jsonify({
+        "inference": batcher.stats(),
+        "decoder": decoder_stats(),
+        "models": models.status(),
+        "result_cache": result_cache.stats(),
+        "analysis_store": analysis_store.stats(),
+        "stream": stream_stats(),
+        "cpu_pool": cpu_pool.stats(),
+        "prediction_log": prediction_log.stats(),
+    })
+
 # Optional: model warmup endpoint (任意の起動後ウォームアップ用)
+# 全モデルを読み込み、それぞれダミー推論を1回実行する
 @app.get("/warmup")
 def warmup():
-    try:
-        get_model()
-        return jsonify({"warmed": True})
-    except Exception as e:
-        return jsonify({"warmed": False, "error": str(e)}), 500
+    results = models.warmup_all()
+    warmed = all(r["warmed"] for r in results.values())
+    return jsonify({"warmed": warmed, "models": results}), (200 if warmed else 500)
 
 # スクリプトとして実行された場合に Flask サーバーを起動
 if __name__ == '__main__':
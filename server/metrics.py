@@ -0,0 +1,153 @@
+# -----------------------------------------------
+# 処理段階ごとの所要時間の計測と、Prometheus 形式のメトリクス出力
+# ・stage("decode") などの with ブロックで各段階（デコード・特徴量抽出・推論・CREPE・Whisper 等）の時間を計り、
+#   エンドポイント・段階・bar_count ごとのヒストグラムに記録する
+# ・リクエスト全体の時間はエンドポイント・bar_count・ステータスごとのヒストグラムに記録する
+# ・bar_count ラベルは METRICS_BAR_COUNTS の値だけをそのまま使い、それ以外は "other" にまとめる
+#   （クライアントが送る値でラベルの種類が増え続けないようにする）
+# ・METRICS_SERVER_TIMING=1 の場合、そのリクエストの段階ごとの内訳を Server-Timing ヘッダーで返す
+# 計測中のリクエストは contextvars で保持するため、Flask のスレッドでも asyncio のタスクでも使える
+# -----------------------------------------------
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "0") == "1"
+METRICS_BAR_COUNTS = frozenset(os.getenv("METRICS_BAR_COUNTS", "1,2,4").split(","))
+
+# ヒストグラムのバケット境界[s]（デコードの数msから Whisper の数十秒まで）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """ラベルの組ごとにバケット別の件数・合計・件数を持つヒストグラム"""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}  # ラベル値の組 -> [バケット別件数, 合計, 件数]
+
+    def observe(self, value, *label_values):
+        label_values = tuple(str(v) for v in label_values)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """Prometheus のテキスト形式の行を返す"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        for label_values, (counts, total, count) in series:
+            labels = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(self.label_names, label_values))
+            prefix = labels + "," if labels else ""
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stage_seconds = Histogram(
+    "micrie_stage_seconds", "Time spent in each processing stage.", ("endpoint", "stage", "bar_count"),
+)
+request_seconds = Histogram(
+    "micrie_request_seconds", "Total request handling time.", ("endpoint", "bar_count", "status"),
+)
+
+
+def bar_count_label(value):
+    """フォームの bar_count をラベル値にする（未指定は ""、不正な値や METRICS_BAR_COUNTS にない値は "other"）"""
+    if value is None or value == "":
+        return ""
+    try:
+        value = str(int(value))
+    except (TypeError, ValueError):
+        return "other"
+    return value if value in METRICS_BAR_COUNTS else "other"
+
+
+# 計測中の1リクエスト（段階ごとの時間を順に記録する）
+class RequestTimer:
+    __slots__ = ("endpoint", "bar_count", "started", "stages")
+
+    def __init__(self, endpoint, bar_count=""):
+        self.endpoint = endpoint
+        self.bar_count = bar_count_label(bar_count)
+        self.started = time.perf_counter()
+        self.stages = []
+
+    def server_timing(self):
+        """Server-Timing ヘッダーの値（同じ段階が複数回あれば合計する）"""
+        totals = {}
+        for name, seconds in self.stages:
+            totals[name] = totals.get(name, 0.0) + seconds
+        totals["total"] = time.perf_counter() - self.started
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+_current = contextvars.ContextVar("micrie_request_timer", default=None)
+
+
+def begin_request(endpoint, bar_count=""):
+    """リクエストの計測を始める（以降の stage() はこのリクエストのラベルで記録される）"""
+    timer = RequestTimer(endpoint, bar_count)
+    _current.set(timer)
+    return timer
+
+
+def set_bar_count(bar_count):
+    """計測中のリクエストの bar_count ラベルを設定する（フォームを読んだ後に呼ぶ）"""
+    timer = _current.get()
+    if timer is not None:
+        timer.bar_count = bar_count_label(bar_count)
+
+
+def end_request(timer, status):
+    """リクエスト全体の時間を記録し、Server-Timing ヘッダーの値（無効なら None）を返す"""
+    request_seconds.observe(time.perf_counter() - timer.started, timer.endpoint, timer.bar_count, status)
+    if _current.get() is timer:
+        _current.set(None)
+    return timer.server_timing() if METRICS_SERVER_TIMING else None
+
+
+@contextmanager
+def stage(name):
+    """with ブロックの所要時間を、計測中のリクエストの段階 name として記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timer = _current.get()
+        if timer is not None:
+            timer.stages.append((name, elapsed))
+            stage_seconds.observe(elapsed, timer.endpoint, name, timer.bar_count)
+        else:
+            stage_seconds.observe(elapsed, "", name, "")
+
+
+def render_metrics():
+    """/metrics の本文（Prometheus テキスト形式）"""
+    return "\n".join(stage_seconds.render() + request_seconds.render()) + "\n"
+
+
+__all__ = [
+    "Histogram", "METRICS_SERVER_TIMING", "bar_count_label", "begin_request", "end_request", "render_metrics", "set_bar_count", "stage",
+]
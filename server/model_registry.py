@@ -0,0 +1,96 @@
+# -----------------------------------------------
+# 各APIで使うモデル（Keras分類器 / Whisper / CREPE）を一元管理するレジストリ
+# 各Blueprintは読み込み関数とウォームアップ関数を登録し、models.get(name) で取得する
+# モデルはプロセス内で1度だけ、スレッドセーフに読み込まれる
+# MODEL_LOAD_POLICY=eager なら起動時に全モデルを読み込み、lazy なら初回利用時に読み込む
+# background なら起動はすぐに完了させ、バックグラウンドのスレッドで全モデルを読み込み・ウォームアップする
+# eager=False で登録したモデル（プロセスプールのワーカーが読み込むものなど）は、起動時には読み込まず初回利用時だけ読み込む
+# -----------------------------------------------
+import os
+import threading
+import time
+
+from log_config import get_logger
+
+MODEL_LOAD_POLICY = os.getenv("MODEL_LOAD_POLICY", "eager")
+logger = get_logger(__name__)
+
+
+# 登録された1モデル分の情報
+class _ModelEntry:
+    def __init__(self, loader, warmup, eager):
+        self.loader = loader
+        self.warmup = warmup
+        self.eager = eager
+        self.model = None
+        self.lock = threading.Lock()
+        self.load_seconds = None
+
+
+class ModelRegistry:
+    """モデルを名前で登録し、1度だけ読み込んで共有するレジストリ"""
+
+    def __init__(self):
+        self._entries = {}
+
+    def register(self, name, loader, warmup=None, eager=True):
+        """loader() でモデルを読み込み、warmup(model) でダミー推論を行うよう登録する
+
+        eager=False なら load_all / warmup_all では読み込まず、get で初めて使われたときだけ読み込む
+        """
+        self._entries[name] = _ModelEntry(loader, warmup, eager)
+
+    def get(self, name):
+        """モデルを返す（未読み込みならこの場で1度だけ読み込む）"""
+        entry = self._entries[name]
+        if entry.model is None:
+            with entry.lock:
+                if entry.model is None:
+                    logger.info("📦 モデル読み込み中: %s", name)
+                    started = time.perf_counter()
+                    entry.model = entry.loader()
+                    entry.load_seconds = time.perf_counter() - started
+                    logger.info("✅ モデル読み込み完了: %s (%.1fs)", name, entry.load_seconds)
+        return entry.model
+
+    def load_all(self):
+        """登録済みの全モデル（eager=False のものを除く）を読み込む"""
+        for name, entry in self._entries.items():
+            if entry.eager:
+                self.get(name)
+
+    def warmup_all(self):
+        """全モデルを読み込み、ダミー推論を1回ずつ実行して結果を名前ごとに返す"""
+        results = {}
+        for name, entry in self._entries.items():
+            if not entry.eager:
+                results[name] = {"warmed": False, "skipped": "loaded on first use"}
+                continue
+            try:
+                model = self.get(name)
+                if entry.warmup is not None:
+                    entry.warmup(model)
+                results[name] = {"warmed": True}
+            except Exception as e:
+                logger.exception("❌ ウォームアップ失敗: %s: %s", name, e)
+                results[name] = {"warmed": False, "error": str(e)}
+        return results
+
+    def warmup_in_background(self):
+        """別スレッドで全モデルを読み込み・ウォームアップする（起動をブロックしない）"""
+        thread = threading.Thread(target=self.warmup_all, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self):
+        """各モデルの読み込み状況を返す"""
+        return {
+            name: {"loaded": entry.model is not None, "eager": entry.eager, "load_seconds": entry.load_seconds}
+            for name, entry in self._entries.items()
+        }
+
+
+# アプリ全体で共有するレジストリ
+models = ModelRegistry()
+
+__all__ = ["MODEL_LOAD_POLICY", "ModelRegistry", "models"]
@@ -0,0 +1,169 @@
+# -----------------------------------------------
+# 1回のアップロードでリズム分類・音高推定（・Whisper）をまとめて行うAPI（/analyze_all）
+# 音声は1度だけデコードし、同じ PCM を各解析で共有して並行に実行する
+# ・analyses: 実行する解析のカンマ区切り（rhythm / pitch / whisper、既定は MULTI_DEFAULT_ANALYSES）
+# ・結果は /predict の segments、/pitch の pitch_series、/analyze の結果（whisper）を1つの JSON で返す
+# ・各解析の結果キャッシュと再分割用の中間結果は /predict・/pitch・/analyze と共有する
+#   （返したハンドルはそのまま /predict/resegment・/pitch/resegment に使える。中間結果が破棄済みなら null）
+# CPU 処理（特徴量抽出・CREPE・Whisper）は MULTI_WORKER_THREADS 個のスレッドプールで並行に実行する
+# （CPU_POOL_WORKERS を指定した場合、特徴量抽出と CREPE はさらにプロセスプールで実行される）
+# -----------------------------------------------
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Blueprint, jsonify, request
+
+from audio_io import SAMPLE_RATE, DecoderBusy, decode_audio
+from log_config import get_logger
+from pitch_api import crepe_version, new_pitch_entry, segment_entry
+from pitch_core import crepe_config
+from predict_api import FEATURE_MODE, classify_entry, log_predictions, new_rhythm_entry, rhythm_model_version
+from result_cache import analysis_store, cache_key, refresh_handle, result_cache
+from whisper_api import WHISPER_MODEL, classify_whisper_chunks
+
+ANALYSES = ("rhythm", "pitch", "whisper")
+MULTI_DEFAULT_ANALYSES = os.getenv("MULTI_DEFAULT_ANALYSES", "rhythm,pitch")
+MULTI_WORKER_THREADS = int(os.getenv("MULTI_WORKER_THREADS", 2 * len(ANALYSES)))
+
+multi_bp = Blueprint("multi", __name__)
+logger = get_logger(__name__)
+
+# 解析を並行に実行するスレッドプール
+executor = ThreadPoolExecutor(max_workers=MULTI_WORKER_THREADS, thread_name_prefix="multi")
+
+
+# フォームの analyses を解析名のタプルにする（未知の名前があれば ValueError）
+def parse_analyses(value):
+    names = [name.strip() for name in (value or MULTI_DEFAULT_ANALYSES).split(",") if name.strip()]
+    unknown = [name for name in names if name not in ANALYSES]
+    if unknown or not names:
+        raise ValueError(f"Unknown analyses: {', '.join(unknown) or '(none)'} (choose from {', '.join(ANALYSES)})")
+    return tuple(name for name in ANALYSES if name in names)
+
+
+# 解析ごとに、結果キャッシュのキー・再分割用のハンドルと、キャッシュ済みの結果・保持中の中間結果を調べる
+def plan_jobs(data, analyses, tempo, bar_count, config):
+    jobs = {}
+    if "rhythm" in analyses:
+        jobs["rhythm"] = {
+            "key": cache_key("predict", data, rhythm_model_version(), tempo=tempo, bar_count=bar_count),
+            "handle": cache_key("predict-frames", data, FEATURE_MODE),
+        }
+    if "pitch" in analyses:
+        jobs["pitch"] = {
+            "key": cache_key("pitch", data, crepe_version(config), tempo=tempo, bar_count=bar_count),
+            "handle": cache_key("pitch-frames", data, crepe_version(config)),
+        }
+    if "whisper" in analyses:
+        jobs["whisper"] = {
+            "key": cache_key("analyze", data, f"whisper:{WHISPER_MODEL}", tempo=tempo, bar_count=bar_count),
+            "handle": None,
+        }
+    for job in jobs.values():
+        job["result"] = result_cache.get(job["key"])
+        job["entry"] = analysis_store.get(job["handle"]) if job["result"] is None and job["handle"] else None
+    return jobs
+
+
+# キャッシュにも中間結果にもない解析があり、音声のデコードが必要か
+def needs_decode(jobs):
+    return any(job["result"] is None and job["entry"] is None for job in jobs.values())
+
+
+# 未計算の解析ごとに、引数なしで呼び出せる処理を返す（y はデコード済みの PCM。各解析で共有しコピーしない）
+def job_tasks(jobs, y, tempo, bar_count, config):
+    tasks = {}
+    rhythm = jobs.get("rhythm")
+    if rhythm is not None and rhythm["result"] is None:
+        def run_rhythm():
+            if rhythm["entry"] is None:
+                rhythm["entry"] = new_rhythm_entry(y, SAMPLE_RATE)
+                analysis_store.put(rhythm["handle"], rhythm["entry"])
+            return classify_entry(rhythm["entry"], tempo, bar_count)
+        tasks["rhythm"] = run_rhythm
+
+    pitch = jobs.get("pitch")
+    if pitch is not None and pitch["result"] is None:
+        def run_pitch():
+            if pitch["entry"] is None:
+                pitch["entry"] = new_pitch_entry(y, config)
+                analysis_store.put(pitch["handle"], pitch["entry"])
+            return segment_entry(pitch["entry"], tempo, bar_count)
+        tasks["pitch"] = run_pitch
+
+    whisper = jobs.get("whisper")
+    if whisper is not None and whisper["result"] is None:
+        tasks["whisper"] = lambda: classify_whisper_chunks(y, SAMPLE_RATE, tempo, bar_count)
+    return tasks
+
+
+# 処理をスレッドプールで並行に実行し、名前ごとの結果を返す（段階ごとの計測が同じリクエストに記録されるよう contextvars を引き継ぐ）
+def run_concurrently(tasks):
+    if len(tasks) <= 1:
+        return {name: func() for name, func in tasks.items()}
+    futures = {name: executor.submit(contextvars.copy_context().run, func) for name, func in tasks.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+# 新しく計算した結果を各解析の結果キャッシュに入れ、まとめたレスポンスを返す
+# リズムの結果はキャッシュ済みだった場合も推論ログに渡す（/predict と同じ）
+# キャッシュ済みだった解析のハンドルは中間結果を延命し、既に破棄されていれば null にする
+def merge_results(jobs, outputs, tempo, bar_count, request_id=None):
+    if "rhythm" in outputs:
+        jobs["rhythm"]["result"] = {"segments": outputs["rhythm"], "handle": jobs["rhythm"]["handle"]}
+    if "rhythm" in jobs:
+        log_predictions(jobs["rhythm"]["result"]["segments"], tempo, bar_count, request_id)
+    if "pitch" in outputs:
+        jobs["pitch"]["result"] = {"pitch_series": outputs["pitch"], "handle": jobs["pitch"]["handle"]}
+    if "whisper" in outputs:
+        jobs["whisper"]["result"] = outputs["whisper"]
+    for name in outputs:
+        result_cache.put(jobs[name]["key"], jobs[name]["result"])
+
+    result = {}
+    handles = {}
+    if "rhythm" in jobs:
+        result["segments"] = jobs["rhythm"]["result"]["segments"]
+        handles["rhythm"] = refresh_handle(jobs["rhythm"]["result"])["handle"]
+    if "pitch" in jobs:
+        result["pitch_series"] = jobs["pitch"]["result"]["pitch_series"]
+        handles["pitch"] = refresh_handle(jobs["pitch"]["result"])["handle"]
+    if "whisper" in jobs:
+        result["whisper"] = jobs["whisper"]["result"]
+    result["handles"] = handles
+    return result
+
+
+# 音声ファイルとテンポ情報を受け取り、指定された解析をまとめて実行して1つの JSON で返すエンドポイント
+@multi_bp.route("/analyze_all", methods=["POST"])
+def analyze_all():
+    if "file" not in request.files:
+        logger.warning("No file received!")
+        return jsonify({"error": "No file uploaded"}), 400
+    try:
+        analyses = parse_analyses(request.form.get("analyses"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    tempo = float(request.form.get("tempo", 120))
+    bar_count = int(request.form.get("bar_count", 1))
+    config = crepe_config(request.form)
+    data = request.files["file"].read()
+
+    jobs = plan_jobs(data, analyses, tempo, bar_count, config)
+    try:
+        # 中間結果のない解析があれば、アップロードされた音声を1度だけ 16kHz モノラル PCM にデコードする
+        y = decode_audio(data) if needs_decode(jobs) else None
+        outputs = run_concurrently(job_tasks(jobs, y, tempo, bar_count, config))
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logger.exception("🔥 エラー発生: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify(merge_results(jobs, outputs, tempo, bar_count, request.headers.get("X-Request-ID"))), 200
+
+
+__all__ = ["multi_bp", "job_tasks", "merge_results", "needs_decode", "parse_analyses", "plan_jobs", "run_concurrently"]
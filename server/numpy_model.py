@@ -0,0 +1,116 @@
+# -----------------------------------------------
+# リズム分類器（全結合 105→64→32→4）の軽量推論バックエンド
+# 学習済みKerasモデルの重みを NumPy の .npz に書き出し、
+# TensorFlow/Keras なしで NumPy だけで順伝播を行う
+# 使い方（書き出し＋Keras出力との一致確認。コミット済みの .npz の確認は test_numpy_model.py）:
+#   python numpy_model.py [model/micrie_model.keras] [model/micrie_model.npz]
+# -----------------------------------------------
+import os
+import sys
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_KERAS_PATH = os.path.join(BASE_DIR, "model", "micrie_model.keras")
+DEFAULT_NPZ_PATH = os.path.join(BASE_DIR, "model", "micrie_model.npz")
+
+# Keras と出力が一致しているとみなす許容誤差（softmax 出力の最大絶対誤差）
+PARITY_ATOL = 1e-5
+
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+
+def _softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def _linear(x):
+    return x
+
+
+ACTIVATIONS = {"relu": _relu, "softmax": _softmax, "linear": _linear}
+
+
+class NumpyDenseModel:
+    """Dense 層を重ねたモデルを NumPy だけで推論する（Keras の model.predict と同じ呼び方）"""
+
+    def __init__(self, kernels, biases, activations):
+        for name in activations:
+            if name not in ACTIVATIONS:
+                raise ValueError(f"unsupported activation: {name}")
+        self.kernels = [np.asarray(k, dtype=np.float32) for k in kernels]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.activations = list(activations)
+
+    @classmethod
+    def load(cls, path):
+        """export_npz で書き出した .npz から読み込む"""
+        with np.load(path) as data:
+            activations = [str(a) for a in data["activations"]]
+            kernels = [data[f"kernel_{i}"] for i in range(len(activations))]
+            biases = [data[f"bias_{i}"] for i in range(len(activations))]
+        return cls(kernels, biases, activations)
+
+    @property
+    def input_shape(self):
+        return (None, self.kernels[0].shape[0])
+
+    def predict(self, x, verbose=0):
+        x = np.asarray(x, dtype=np.float32)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            x = ACTIVATIONS[activation](x @ kernel + bias)
+        return x
+
+
+def export_npz(keras_model, path):
+    """Keras の Dense 層の重みと活性化関数を .npz に書き出す"""
+    arrays = {}
+    activations = []
+    for layer in keras_model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue  # Input 層など重みを持たない層は飛ばす
+        config = layer.get_config()
+        if "activation" not in config or len(weights) != 2:
+            raise ValueError(f"unsupported layer for numpy export: {layer.name}")
+        i = len(activations)
+        arrays[f"kernel_{i}"] = weights[0].astype(np.float32)
+        arrays[f"bias_{i}"] = weights[1].astype(np.float32)
+        activations.append(config["activation"])
+    np.savez(path, activations=np.array(activations), **arrays)
+    return path
+
+
+def check_parity(keras_model, numpy_model, n_rows=256, seed=0):
+    """ランダムな特徴ベクトル（と無音時の0ベクトル）で両者の出力の最大絶対誤差を返す"""
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n_rows, numpy_model.input_shape[1])) * 10
+    x[0] = 0
+    expected = keras_model.predict(x, verbose=0)
+    actual = numpy_model.predict(x)
+    return float(np.max(np.abs(expected - actual)))
+
+
+def main():
+    keras_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_KERAS_PATH
+    npz_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_NPZ_PATH
+
+    from keras.models import load_model
+
+    keras_model = load_model(keras_path)
+    export_npz(keras_model, npz_path)
+    print(f"✅ NumPy 形式で保存: {npz_path}")
+
+    diff = check_parity(keras_model, NumpyDenseModel.load(npz_path))
+    print(f"🔍 Keras との最大絶対誤差: {diff:.3e}")
+    if diff > PARITY_ATOL:
+        print(f"❌ 許容誤差 {PARITY_ATOL} を超えています")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,155 +1,128 @@
 # -----------------------------------------------
-# 音声ファイルを受け取り、ffmpegで.wavに変換した後、
+# 音声ファイルを受け取り、ffmpegで16kHzモノラルPCMにデコードした後、
 # CREPEを用いて音高を推定し、1小節を8分割して各セグメントの
 # ピッチ、信頼度、RMSなどの情報をJSONで返すAPI
 # FlaskのBlueprintを使用してルーティング処理を実装
+# CREPE の実行とチャンクの判定は pitch_core.py（プロセスプールのワーカーと共通）
 # -----------------------------------------------
 from flask import Blueprint, request, jsonify
-import librosa
-import tempfile
-import os
-import ffmpeg
 from flask_cors import cross_origin
-import crepe
-import soundfile as sf
+import threading
 import numpy as np
+from audio_io import SAMPLE_RATE, DecoderBusy, decode_audio
+from cpu_pool import cpu_pool, pitch_task
+from log_config import get_logger
+from metrics import stage
+from model_registry import models
+from pitch_core import CREPE_CAPACITY, PITCH_GATE_PAD, PITCH_GATE_RMS, crepe_config, crepe_frames, load_crepe_model, run_crepe, segment_pitch
+from result_cache import analysis_store, cache_key, refresh_handle, result_cache
 
 pitch_bp = Blueprint("pitch", __name__)
+logger = get_logger(__name__)
+
+# 結果キャッシュのキーに含めるバージョン（CREPE の設定と有声区間ゲートの閾値・余白）
+def crepe_version(config):
+    return f"crepe:{config['capacity']}:{config['step_size']}:{int(config['viterbi'])}:{PITCH_GATE_RMS}:{PITCH_GATE_PAD}"
+
+# CREPEモデルをモデルレジストリに登録（crepe.predict は読み込み済みのモデルを使い回す）
+# CPU_POOL_STAGES で CREPE をプロセスプールに任せる場合は、ワーカーが読み込むため本体では起動時に読み込まない
+# （ストリーミング解析では本体で CREPE を使うので、その場合も初回利用時には読み込む）
+def warmup_crepe_model(model):
+    run_crepe(np.zeros(SAMPLE_RATE, dtype=np.float32), SAMPLE_RATE, crepe_config())
+
+models.register("crepe", load_crepe_model, warmup=warmup_crepe_model, eager=not cpu_pool.runs("pitch"))
+
+# 既定の容量の CREPE はレジストリ経由で読み込む（/stats の読み込み状況に反映される）
+def ensure_crepe_model(config):
+    if config["capacity"] == CREPE_CAPACITY:
+        models.get("crepe")
 
 # 音声ファイルを受け取り、ピッチ推定結果をJSONで返すエンドポイント
 @pitch_bp.route('/pitch', methods=['POST'])
 @cross_origin()  # Use app-level CORS (localhost:5173, *.vercel.app, PROD_ORIGIN, etc.)
 def analyze_pitch():
-    print("✅ /pitch にリクエスト来たよ！")
-    print("📦 リクエスト内容：", request.files)
+    logger.debug("✅ /pitch にリクエスト来たよ！ 📦 %s", request.files)
     
     if 'file' not in request.files:
-        print("No file received!") 
+        logger.warning("No file received!")
         return jsonify({'error': 'No file uploaded'}), 400
 
     file = request.files['file']
+    tempo = float(request.form.get("tempo", 120))
+    bar_count = int(request.form.get("bar_count", 1))
+    config = crepe_config(request.form)
+    data = file.read()
+
+    # 同じ録音・同じ設定の結果がキャッシュにあれば、デコードや CREPE を行わずに返す
+    key = cache_key("pitch", data, crepe_version(config), tempo=tempo, bar_count=bar_count)
+    cached = result_cache.get(key)
+    if cached is not None:
+        logger.debug("♻️ キャッシュ済みの結果を返します")
+        # 結果キャッシュは中間結果より長く残るため、ハンドルが破棄済みなら null にして返す
+        return jsonify(refresh_handle(cached)), 200
+
+    # 同じ録音の CREPE の結果が残っていれば（テンポだけ変えた再送信など）、デコードせずに使い回す
+    handle = cache_key("pitch-frames", data, crepe_version(config))
+    entry = analysis_store.get(handle)
 
-    # 受け取ったファイルを一時保存し、.webm から .wav へ変換
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp_webm:
-        file.save(tmp_webm.name)
-        webm_path = tmp_webm.name
-
-    wav_path = webm_path.replace(".webm", ".wav")
+    try:
+        if entry is None:
+            # アップロードされた音声をメモリ上で 16kHz モノラル PCM にデコード（リサンプリングも ffmpeg 側で行う）
+            entry = new_pitch_entry(decode_audio(data), config)
+            analysis_store.put(handle, entry)
+
+        # CREPE を用いて音高と信頼度を予測し、テンポ情報を元に1小節を16分割して各チャンクの音高を判定
+        # 無音と分かっているチャンクは CREPE を実行せず、rest として扱う
+        segments = segment_entry(entry, tempo, bar_count)
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.exception("❌ 音声読み込みまたはCREPE予測でエラー: %s", e)
+        return jsonify({'error': 'Failed to load audio or predict pitch'}), 500
+
+    result = {'pitch_series': segments, 'handle': handle}
+    result_cache.put(key, result)
+    return jsonify(result), 200
+
+# /pitch が返したハンドルと新しいテンポ情報を受け取り、保持している CREPE の結果から再分割するエンドポイント
+# 音声のデコードは行わず、CREPE は以前のテンポでは無音として省いたフレームが必要な場合にだけ実行する
+@pitch_bp.route('/pitch/resegment', methods=['POST'])
+@cross_origin()
+def resegment_pitch():
+    handle = request.form.get("handle")
+    tempo = float(request.form.get("tempo", 120))
+    bar_count = int(request.form.get("bar_count", 1))
+
+    entry = analysis_store.get(handle) if handle else None
+    if entry is None or entry["kind"] != "pitch":
+        return jsonify({'error': 'Unknown or expired handle, please upload the file again'}), 404
 
     try:
-        ffmpeg.input(webm_path).output(wav_path).run(quiet=True, overwrite_output=True)
-
-        try:
-            y, sr = sf.read(wav_path)
-            # ステレオ音声はモノラルに変換し、サンプリングレートを16kHzに統一
-            if len(y.shape) > 1:
-                y = np.mean(y, axis=1)  # モノラル化
-
-            if sr != 16000:
-                y = librosa.resample(y, orig_sr=sr, target_sr=16000)
-                sr = 16000
-
-            # CREPE を用いて音高と信頼度を予測
-            time, frequency, confidence, _ = crepe.predict(y, sr, viterbi=True)
-        except Exception as e:
-            print("❌ 音声読み込みまたはCREPE予測でエラー:", e)
-            return jsonify({'error': 'Failed to load audio or predict pitch'}), 500
-
-        # テンポ情報を元に、1小節を16分割し、各チャンクを生成
-        tempo = float(request.form.get("tempo", 120))  
-        bar_count = int(request.form.get("bar_count", 1))
-        beat_duration = 60.0 / tempo
-        total_duration = beat_duration * 4 * bar_count  # 1 bar = 4 beats
-        chunk_duration = total_duration / (16 * bar_count)
-
-        # 1秒あたりのフレーム数を推定
-        fps = len(frequency) / total_duration
-        frames_per_chunk = int(fps * chunk_duration)
-
-        segments = []
-        skip = int(frames_per_chunk * 0.1)
-        margin = 0.05  # RMS計算のための50msのマージン作成(しゃくり除去)
-
-        total_chunks = 16 * bar_count
-        # 各チャンクに対してピッチとRMSを計算し、信頼度に基づいて rest か note を判定
-        for i in range(total_chunks):
-            original_start = i * frames_per_chunk
-            original_end = (i + 1) * frames_per_chunk
-            start = original_start
-            end = original_end
-
-            # 初期チャンクで仮のセグメントとピーク確認
-            segment = frequency[start + skip:end]
-            segment_conf = confidence[start + skip:end]
-            peak_index = np.argmax(segment_conf)
-            early_threshold = int(frames_per_chunk * 0.2)
-
-            # ピークがチャンク先頭に近ければ、少し前倒し
-            if peak_index < early_threshold and i > 0:
-                shift = int(frames_per_chunk * 0.2)
-                start = max(0, original_start - shift)
-                end = original_end - shift
-                segment = frequency[start + skip:end]
-                segment_conf = confidence[start + skip:end]
-
-            valid = [(hz, conf) for hz, conf in zip(segment, segment_conf) if hz > 0 and conf > 0.5]
-
-            start_time = i * chunk_duration
-            end_time = (i + 1) * chunk_duration
-
-            start_sample = max(0, int((start_time - margin) * sr))
-            end_sample = int((end_time + margin) * sr)
-            segment_audio = y[start_sample:end_sample]
-            segment_rms = np.sqrt(np.mean(np.square(segment_audio)))
-
-            if not valid:
-                confidence_rms_score = 0.0
-                segments.append({
-                    "label": "rest",
-                    "note": "rest",
-                    "hz": 0.0,
-                    "confidence": 0.0,
-                    "confidence_rms": float(confidence_rms_score),
-                    "rms": float(segment_rms),
-                    "start": round(start_time, 2),
-                    "end": round(end_time, 2)
-                })
-                continue
-
-            freqs, weights = zip(*valid)
-            confidence_rms_score = np.mean([conf * segment_rms for conf in weights])
-            if confidence_rms_score < 0.03:
-                segments.append({
-                    "label": "rest",
-                    "note": "rest",
-                    "hz": 0.0,
-                    "confidence": float(confidence_rms_score),
-                    "confidence_rms": float(confidence_rms_score),
-                    "rms": float(segment_rms),
-                    "start": round(start_time, 2),
-                    "end": round(end_time, 2)
-                })
-            else:
-                log_freqs = np.log2(freqs)
-                log_weighted_avg = np.average(log_freqs, weights=weights)
-                avg_pitch = 2 ** log_weighted_avg
-                note_name = librosa.hz_to_note(avg_pitch).replace('♯', '#').replace('＃', '#')
-                segments.append({
-                    "label": note_name,
-                    "note": note_name,
-                    "hz": float(avg_pitch),
-                    "confidence": float(segment_conf[peak_index]),
-                    "confidence_rms": float(confidence_rms_score),
-                    "rms": float(segment_rms),
-                    "start": round(start_time, 2),
-                    "end": round(end_time, 2)
-                })
-
-        return jsonify({'pitch_series': segments}), 200
-    # 一時ファイルを削除
-    finally:
-        for path in [webm_path, wav_path]:
-            if os.path.exists(path):
-                os.remove(path)
-
-__all__ = ["pitch_bp"]
\ No newline at end of file
+        segments = segment_entry(entry, tempo, bar_count)
+    except Exception as e:
+        logger.exception("❌ 再分割でエラー: %s", e)
+        return jsonify({'error': 'Failed to resegment pitch'}), 500
+    return jsonify({'pitch_series': segments, 'handle': handle}), 200
+
+# 再分割用に保持する1録音分の中間結果（PCM・CREPE の設定・フレーム単位の CREPE 結果）
+def new_pitch_entry(y, config):
+    return {"kind": "pitch", "y": y, "config": config, "frames": None, "lock": threading.Lock()}
+
+# 保持している録音を tempo / bar_count で分割して判定する（足りないフレームだけ CREPE を実行）
+# CPU_POOL_WORKERS を指定した場合、CREPE と判定はプロセスプールで実行する
+def segment_entry(entry, tempo, bar_count):
+    with entry["lock"]:
+        if cpu_pool.runs("pitch"):
+            # ワーカーでの CREPE と判定をまとめて crepe 段階として計測する
+            with stage("crepe"):
+                entry["frames"], segments = cpu_pool.run(pitch_task, entry["y"], SAMPLE_RATE, entry["config"], tempo, bar_count, entry["frames"])
+            return segments
+        y = entry["y"]
+        ensure_crepe_model(entry["config"])
+        entry["frames"] = crepe_frames(y, SAMPLE_RATE, entry["config"], tempo, bar_count, entry["frames"])
+        frames = entry["frames"]
+        with stage("segment"):
+            return segment_pitch(y, SAMPLE_RATE, frames["frequency"], frames["confidence"], tempo, bar_count)
+
+__all__ = ["pitch_bp", "crepe_version", "ensure_crepe_model", "new_pitch_entry", "segment_entry"]
\ No newline at end of file
@@ -0,0 +1,266 @@
+# -----------------------------------------------
+# CREPE による音高推定と、1小節16分割のチャンクごとの判定（pitch_api・stream_api・プロセスプールのワーカーで共通）
+# Flask やモデルレジストリ・結果キャッシュに依存しないため、ワーカーはこのモジュールだけを読み込めばよい
+# ・crepe_frames: 判定に必要なフレームだけ CREPE を実行する（有声区間ゲート）
+# ・segment_pitch: フレームごとの周波数・信頼度をチャンクに分け、rest か音名に判定する
+# -----------------------------------------------
+import os
+import threading
+
+import librosa
+import numpy as np
+
+from metrics import stage
+
+# CREPEの設定（モデル容量・フレーム間隔[ms]・Viterbi平滑化）
+# CREPE_ALLOW_REQUEST_HINTS=1 の場合のみ、リクエストの crepe_capacity / crepe_step_size / crepe_viterbi で上書きできる
+CREPE_CAPACITIES = ("tiny", "small", "medium", "large", "full")
+CREPE_CAPACITY = os.getenv("CREPE_CAPACITY", "full")
+CREPE_STEP_SIZE = int(os.getenv("CREPE_STEP_SIZE", 10))
+CREPE_VITERBI = os.getenv("CREPE_VITERBI", "1") == "1"
+CREPE_ALLOW_REQUEST_HINTS = os.getenv("CREPE_ALLOW_REQUEST_HINTS", "0") == "1"
+CREPE_MAX_STEP_SIZE = 100
+
+# 信頼度×RMS がこの値未満のチャンクは rest と判定する
+REST_THRESHOLD = 0.03
+RMS_MARGIN = 0.05  # RMS計算のための50msのマージン作成(しゃくり除去)
+
+# 有声区間ゲート: RMS がこの値未満のチャンクは CREPE を実行しない（0 で無効）
+# PITCH_GATE_PAD は CREPE を実行する区間の前後に付ける余白[s]（Viterbi 平滑化の文脈用）
+PITCH_GATE_RMS = float(os.getenv("PITCH_GATE_RMS", REST_THRESHOLD))
+PITCH_GATE_PAD = float(os.getenv("PITCH_GATE_PAD", 0.1))
+CREPE_WINDOW = 1024  # CREPE の1フレームの窓長（サンプル数）
+
+# 同じ容量のモデルを同時に組み立てないためのロック
+_crepe_build_lock = threading.Lock()
+
+# サーバー設定（と許可されていればリクエストのヒント）から CREPE の設定を決める関数
+# form は Flask / Starlette どちらのフォームでもよい（get(key, default) だけを使う）
+def crepe_config(form=None):
+    config = {"capacity": CREPE_CAPACITY, "step_size": CREPE_STEP_SIZE, "viterbi": CREPE_VITERBI}
+    if form is None or not CREPE_ALLOW_REQUEST_HINTS:
+        return config
+
+    capacity = form.get("crepe_capacity")
+    if capacity in CREPE_CAPACITIES:
+        config["capacity"] = capacity
+    step_size = form.get("crepe_step_size", "")
+    if step_size.isdigit() and 1 <= int(step_size) <= CREPE_MAX_STEP_SIZE:
+        config["step_size"] = int(step_size)
+    viterbi = form.get("crepe_viterbi")
+    if viterbi in ("0", "1"):
+        config["viterbi"] = viterbi == "1"
+    return config
+
+# 指定した容量の CREPE モデルを組み立てて読み込む関数（crepe は容量ごとにモデルをキャッシュするため、2回目以降はすぐ返る）
+# crepe は TensorFlow を読み込むため、起動を軽くするよう初回利用時にインポートする
+def load_crepe_model(capacity=CREPE_CAPACITY):
+    import crepe
+    with _crepe_build_lock:
+        return crepe.core.build_and_load_model(capacity)
+
+# 指定の設定で CREPE を実行し、フレームごとの周波数と信頼度を返す関数
+def run_crepe(y, sr, config, center=True):
+    import crepe
+    load_crepe_model(config["capacity"])
+    with stage("crepe"):
+        _, frequency, confidence, _ = crepe.predict(
+            y, sr,
+            model_capacity=config["capacity"],
+            viterbi=config["viterbi"],
+            step_size=config["step_size"],
+            center=center,
+            verbose=0,
+        )
+    return frequency, confidence
+
+# 無音チャンクを事前に除外して CREPE を実行する関数（有声区間ゲート）
+# 前後マージン込みのRMSが PITCH_GATE_RMS 未満のチャンクは、信頼度が最大1でも 信頼度×RMS が
+# rest の閾値に届かないため、CREPE を実行せず rest にしてよい（既定値は rest の閾値と同じ）
+# 残りのチャンクが参照するフレーム範囲（前倒し分を含む）だけ CREPE を実行し、
+# 録音全体と同じ長さ・同じフレーム位置の周波数/信頼度配列に書き込んで返す
+def run_crepe_gated(y, sr, config, tempo, bar_count):
+    frames = crepe_frames(y, sr, config, tempo, bar_count)
+    return frames["frequency"], frames["confidence"]
+
+# フレーム単位の CREPE 結果（周波数・信頼度と、計算済みかどうかのマスク）を、
+# tempo / bar_count の判定に必要な分だけ埋めて返す関数
+# frames に以前の結果を渡すと、未計算のフレームだけ CREPE を実行する（テンポ変更時の再分割用）
+def crepe_frames(y, sr, config, tempo, bar_count, frames=None):
+    hop = int(sr * config["step_size"] / 1000)
+    n_frames = 1 + len(y) // hop  # center=True で録音全体に CREPE をかけた場合のフレーム数
+    if frames is None:
+        frames = {
+            "frequency": np.zeros(n_frames),
+            "confidence": np.zeros(n_frames, dtype=np.float32),
+            "covered": np.zeros(n_frames, dtype=bool),
+        }
+    covered = frames["covered"]
+    missing = needed_frames(y, sr, n_frames, tempo, bar_count) & ~covered
+    if not missing.any():
+        return frames
+    if missing.all():
+        frequency, confidence = run_crepe(y, sr, config)
+        frames["frequency"][:] = frequency[:n_frames]
+        frames["confidence"][:] = confidence[:n_frames]
+        covered[:] = True
+        return frames
+
+    # 未計算の区間を求め、前後 PITCH_GATE_PAD 秒の余白（Viterbi 平滑化の文脈用）が重なる区間はまとめる
+    pad = int(round(PITCH_GATE_PAD * 1000 / config["step_size"]))
+    edges = np.diff(np.concatenate([[0], missing.view(np.int8), [0]]))
+    spans = []
+    for start, end in zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()):
+        if spans and start - pad <= spans[-1][1] + pad:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+
+    # center=True と同じ無音パディングをした音声から、各フレームの窓（1024サンプル）を含む区間を切り出して実行
+    # 計算済みのフレームは上書きしない
+    y_padded = np.pad(y, CREPE_WINDOW // 2)
+    for start, end in spans:
+        run_start, run_end = max(0, start - pad), min(n_frames, end + pad)
+        span_audio = y_padded[run_start * hop:(run_end - 1) * hop + CREPE_WINDOW]
+        span_frequency, span_confidence = run_crepe(span_audio, sr, config, center=False)
+        write = ~covered[start:end]
+        frames["frequency"][start:end][write] = span_frequency[start - run_start:end - run_start][write]
+        frames["confidence"][start:end][write] = span_confidence[start - run_start:end - run_start][write]
+        covered[start:end] = True
+    return frames
+
+# tempo / bar_count のチャンク分割で判定に使うフレームのマスクを返す関数
+# 無音チャンク（RMS が PITCH_GATE_RMS 未満）だけが参照するフレームは含めない
+def needed_frames(y, sr, n_frames, tempo, bar_count):
+    if PITCH_GATE_RMS <= 0:
+        return np.ones(n_frames, dtype=bool)
+    chunk_duration, total_chunks, frames_per_chunk = chunk_grid(n_frames, tempo, bar_count)
+    rms = chunk_rms(y, sr, chunk_duration, total_chunks)
+    candidates = np.flatnonzero(~(rms < PITCH_GATE_RMS))
+    if len(candidates) == total_chunks:
+        return np.ones(n_frames, dtype=bool)
+
+    # 各候補チャンクの範囲（先頭は前倒し分を含む）を差分配列で塗る
+    shift = int(frames_per_chunk * 0.2)
+    starts = np.clip(candidates * frames_per_chunk - shift, 0, n_frames)
+    ends = np.clip((candidates + 1) * frames_per_chunk, 0, n_frames)
+    marks = np.zeros(n_frames + 1, dtype=int)
+    np.add.at(marks, starts, 1)
+    np.add.at(marks, ends, -1)
+    return np.cumsum(marks[:-1]) > 0
+
+# CREPEのフレーム数とテンポから、チャンク長[s]・チャンク数・1チャンクあたりのフレーム数を求める関数
+def chunk_grid(n_frames, tempo, bar_count):
+    beat_duration = 60.0 / tempo
+    total_duration = beat_duration * 4 * bar_count  # 1 bar = 4 beats
+    chunk_duration = total_duration / (16 * bar_count)
+
+    # 1秒あたりのフレーム数を推定
+    fps = n_frames / total_duration
+    frames_per_chunk = int(fps * chunk_duration)
+    return chunk_duration, 16 * bar_count, frames_per_chunk
+
+# 各チャンクの前後50msのマージンを含めた区間のRMSを、二乗の累積和から一括計算する関数
+def chunk_rms(y, sr, chunk_duration, total_chunks):
+    chunk_ids = np.arange(total_chunks)
+    start_times = chunk_ids * chunk_duration
+    end_times = (chunk_ids + 1) * chunk_duration
+    start_samples = np.minimum(np.maximum(0, ((start_times - RMS_MARGIN) * sr).astype(int)), len(y))
+    end_samples = np.clip(((end_times + RMS_MARGIN) * sr).astype(int), start_samples, len(y))
+    squared_sum = np.concatenate([[0.0], np.cumsum(np.square(y, dtype=np.float64))])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rms = np.sqrt((squared_sum[end_samples] - squared_sum[start_samples]) / (end_samples - start_samples))
+    return rms.astype(np.result_type(y.dtype, np.float32))
+
+# CREPEの出力（フレームごとの周波数・信頼度）を1小節16分割のチャンクに分け、
+# 各チャンクを rest か音名に判定する関数
+# チャンクのループは行わず、(チャンク数, 窓長) の配列に対するマスク付き集計で一括計算する
+def segment_pitch(y, sr, frequency, confidence, tempo, bar_count):
+    chunk_duration, total_chunks, frames_per_chunk = chunk_grid(len(frequency), tempo, bar_count)
+
+    skip = int(frames_per_chunk * 0.1)
+    early_threshold = int(frames_per_chunk * 0.2)
+    shift = int(frames_per_chunk * 0.2)
+
+    frequency = np.asarray(frequency)
+    confidence = np.asarray(confidence)
+    chunk_ids = np.arange(total_chunks)
+
+    # 各チャンクの解析窓 [start + skip, end) のフレーム番号を (チャンク数, 窓長) で作り、ピーク位置を確認
+    window = chunk_ids[:, None] * frames_per_chunk + np.arange(skip, frames_per_chunk)[None, :]
+    peak_index = np.argmax(confidence[window], axis=1)
+
+    # ピークがチャンク先頭に近ければ、少し前倒し（先頭チャンクは除く）
+    shifted = (peak_index < early_threshold) & (chunk_ids > 0)
+    window = window - np.where(shifted, shift, 0)[:, None]
+    segment = frequency[window]
+    segment_conf = confidence[window]
+    peak_conf = segment_conf[chunk_ids, peak_index]
+
+    # 有効フレーム（hz > 0 かつ 信頼度 > 0.5）のマスク付き集計
+    valid = (segment > 0) & (segment_conf > 0.5)
+    n_valid = np.count_nonzero(valid, axis=1)
+    weights = np.where(valid, segment_conf, 0.0)
+    weight_sum = np.sum(weights, axis=1)
+
+    segment_rms = chunk_rms(y, sr, chunk_duration, total_chunks)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # 信頼度×RMSの平均と、信頼度で重み付けした対数周波数の平均
+        confidence_rms_score = segment_rms * weight_sum / n_valid
+        log_freqs = np.log2(np.where(valid, segment, 1.0))
+        avg_pitch = 2 ** (np.sum(weights * log_freqs, axis=1) / weight_sum)
+
+    is_note = (n_valid > 0) & ~(confidence_rms_score < REST_THRESHOLD)
+    note_names = {}
+    if np.any(is_note):
+        names = librosa.hz_to_note(avg_pitch[is_note])
+        note_names = {
+            i: name.replace('♯', '#').replace('＃', '#')
+            for i, name in zip(np.flatnonzero(is_note), names)
+        }
+
+    segments = []
+    for i in range(total_chunks):
+        start_time = i * chunk_duration
+        end_time = (i + 1) * chunk_duration
+        if n_valid[i] == 0:
+            segments.append({
+                "label": "rest",
+                "note": "rest",
+                "hz": 0.0,
+                "confidence": 0.0,
+                "confidence_rms": 0.0,
+                "rms": float(segment_rms[i]),
+                "start": round(start_time, 2),
+                "end": round(end_time, 2)
+            })
+        elif not is_note[i]:
+            segments.append({
+                "label": "rest",
+                "note": "rest",
+                "hz": 0.0,
+                "confidence": float(confidence_rms_score[i]),
+                "confidence_rms": float(confidence_rms_score[i]),
+                "rms": float(segment_rms[i]),
+                "start": round(start_time, 2),
+                "end": round(end_time, 2)
+            })
+        else:
+            segments.append({
+                "label": note_names[i],
+                "note": note_names[i],
+                "hz": float(avg_pitch[i]),
+                "confidence": float(peak_conf[i]),
+                "confidence_rms": float(confidence_rms_score[i]),
+                "rms": float(segment_rms[i]),
+                "start": round(start_time, 2),
+                "end": round(end_time, 2)
+            })
+    return segments
+
+
+__all__ = [
+    "CREPE_CAPACITIES", "CREPE_CAPACITY", "CREPE_WINDOW", "PITCH_GATE_PAD", "PITCH_GATE_RMS", "REST_THRESHOLD",
+    "chunk_grid", "chunk_rms", "crepe_config", "crepe_frames", "load_crepe_model", "needed_frames", "run_crepe",
+    "run_crepe_gated", "segment_pitch",
+]
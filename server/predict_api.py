@@ -3,117 +3,126 @@
 # テンポに基づいて音声を8分割し、各チャンクから特徴量を抽出して分類
 # 推論結果はJSONとして返却し、CSVにログとして保存
 # FlaskのBlueprintを使用してエンドポイントを提供
+# チャンク分割と特徴量抽出は rhythm_core.py（プロセスプールのワーカーと共通）
 # -----------------------------------------------
 from flask import Blueprint, request, jsonify
 import numpy as np
-import librosa
 import os
-import tempfile
-import ffmpeg
-from keras.models import load_model
-import csv
-from datetime import datetime
-
-
-# 音声信号から様々な音響特徴量を抽出して、1次元の特徴ベクトルとして返す関数
-# 拡張された特徴抽出関数
-def extract_features(y, sr):
-    print("📂 特徴抽出中（推論）")
-
-    # 無音判定: RMS最大値が閾値未満ならnoiseとみなす
-    rms = librosa.feature.rms(y=y)
-    print("🔍 RMS max:", np.max(rms))
-    if np.max(rms) < 0.007:
-        # print("🔇 無音と判断: noise特徴量を返します")
-        return np.zeros(105)
-
-    """拡張された特徴抽出関数: MFCC(13), ΔMFCC, ZCR, RMS, Centroidなど"""
-    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-    width = min(5, mfccs.shape[1] // 2 * 2 + 1)
-    delta_mfccs = librosa.feature.delta(mfccs, width=width)
-    zcr = librosa.feature.zero_crossing_rate(y)
-    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
-    bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
-    flatness = librosa.feature.spectral_flatness(y=y)
-    rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
-    contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
-
-    freqs = librosa.fft_frequencies(sr=sr)
-    S = np.abs(librosa.stft(y))
-    high_freq_mask = freqs >= 4000
-    high_energy = np.mean(S[high_freq_mask, :])
-    total_energy = np.mean(S)
-    high_energy_ratio = high_energy / (total_energy + 1e-6)
-    # 低域エネルギー比
-    low_freq_mask = freqs <= 250
-    low_energy = np.mean(S[low_freq_mask, :])
-    low_energy_ratio = low_energy / (total_energy + 1e-6)
-
-    spectral_flux = np.sqrt(np.mean(np.diff(S, axis=1)**2))
-    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-
-    feature_vector = np.concatenate([
-      np.mean(mfccs, axis=1),
-      np.std(mfccs, axis=1),
-      np.mean(delta_mfccs, axis=1),
-      np.std(delta_mfccs, axis=1),
-      np.mean(zcr, axis=1),
-      np.std(zcr, axis=1),
-      np.mean(rms, axis=1),
-      np.std(rms, axis=1),
-      np.mean(centroid, axis=1),
-      np.std(centroid, axis=1),
-      np.mean(bandwidth, axis=1),
-      np.std(bandwidth, axis=1),
-      np.mean(flatness, axis=1),
-      np.std(flatness, axis=1),
-      np.mean(rolloff, axis=1),
-      np.std(rolloff, axis=1),
-      np.mean(contrast, axis=1),
-      np.std(contrast, axis=1),
-      np.array([spectral_flux]).flatten(),
-      np.array([high_energy_ratio]),
-      np.mean(chroma, axis=1),
-      np.std(chroma, axis=1),
-      np.array([low_energy_ratio])
-    ])
-    if feature_vector.shape[0] != 105:
-        print(f"⚠️ 特徴ベクトルの次元が不正です: {feature_vector.shape}")
-    return feature_vector
-
-# 推論結果（各チャンクのラベルとスコア）をCSVファイルに追記する関数
-CSV_LOG_PATH = "./prediction_log.csv"
-
-def log_to_csv(segments):
-    """チャンク毎のスコアと予測ラベルをCSVに追記"""
-    file_exists = os.path.isfile(CSV_LOG_PATH)
-
-    with open(CSV_LOG_PATH, mode='a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(["timestamp", "chunk", "start", "end", "kick", "snare", "hihat", "noise", "label"])
-
-        timestamp = datetime.now().isoformat()
-        for i, seg in enumerate(segments):
-            writer.writerow([
-                timestamp,
-                f"chunk_{i}",
-                seg["start"],
-                seg["end"],
-                *seg["scores"],
-                seg["label"]
-            ])
-
+from inference_queue import MicroBatcher
+from model_registry import models
+from numpy_model import NumpyDenseModel
+from audio_io import SAMPLE_RATE, DecoderBusy, decode_audio
+from features import compute_frames, onset_times
+from rhythm_core import chunk_feature_rows
+from cpu_pool import cpu_pool, rhythm_features_task
+from metrics import stage
+from log_config import SAMPLED, get_logger, sample_debug
+from prediction_log import new_request_id, prediction_log
+from result_cache import analysis_store, cache_key, file_version, refresh_handle, result_cache
+
+logger = get_logger(__name__)
 
 predict_bp = Blueprint("predict", __name__)
 
-# モデルの読み込みと初期設定
-model_path = os.path.join(os.path.dirname(__file__), "model", "micrie_model.keras")
-print(f"📦 モデル読み込み中: {model_path}")
-model = load_model(model_path)
-print("✅ モデル読み込み完了")
+# モデルの登録と初期設定（読み込みはモデルレジストリが1度だけ行う）
+# RHYTHM_BACKEND=numpy なら train_model.py / numpy_model.py で書き出した .npz を NumPy だけで推論する
+RHYTHM_BACKEND = os.getenv("RHYTHM_BACKEND", "keras")
+MODEL_FILE = os.getenv("MODEL_FILE", "micrie_model.keras")
+NPZ_MODEL_FILE = os.getenv("NPZ_MODEL_FILE", "micrie_model.npz")
+model_path = os.path.join(os.path.dirname(__file__), "model", MODEL_FILE)
+npz_model_path = os.path.join(os.path.dirname(__file__), "model", NPZ_MODEL_FILE)
+
+def load_rhythm_model():
+    if RHYTHM_BACKEND == "numpy":
+        return NumpyDenseModel.load(npz_model_path)
+    from keras.models import load_model  # TensorFlow/Keras は初回読み込み時にインポート
+    return load_model(model_path)
+
+def warmup_rhythm_model(model):
+    model.predict(np.zeros((1, 105)))
+
+models.register("rhythm", load_rhythm_model, warmup=warmup_rhythm_model)
 labels = ["kick", "snare", "hihat", "noise"]
 
+# 特徴量の抽出方法: chunk = チャンクごとに抽出 / whole = 録音全体を1度だけ解析し、チャンク範囲で集約
+FEATURE_MODE = os.getenv("FEATURE_MODE", "chunk")
+# 1 なら各チャンクの開始時刻を、半チャンク前までにある直前のオンセット（発音の始まり）にスナップする
+# 0（既定）ではオンセット検出そのものを行わない
+ONSET_SNAP = os.getenv("ONSET_SNAP", "0") == "1"
+
+# 結果キャッシュのキーに含めるモデルのバージョン（モデルファイルが変われば別キーになる）
+def rhythm_model_version():
+    path = npz_model_path if RHYTHM_BACKEND == "numpy" else model_path
+    return f"{RHYTHM_BACKEND}:{file_version(path)}:{FEATURE_MODE}:snap{int(ONSET_SNAP)}"
+
+# 同時リクエストの推論をまとめるマイクロバッチ・キュー（ウィンドウ0でバッチ化を無効化）
+batcher = MicroBatcher(
+    lambda: models.get("rhythm"),
+    window_ms=float(os.getenv("INFER_BATCH_WINDOW_MS", 5)),
+    max_rows=int(os.getenv("INFER_BATCH_MAX_ROWS", 256)),
+)
+
+# 特徴ベクトルを (N, 105) にまとめて1回で推論し、対応するチャンクの結果にラベルとスコアを書き込む関数
+def classify_rows(segments, features_list):
+    if not features_list:
+        return
+    try:
+        features_array = np.stack(features_list)
+        with stage("inference"):
+            predictions = batcher.predict(features_array)
+        predicted_indices = np.argmax(predictions, axis=1)
+    except Exception as e:
+        logger.exception("❌ 推論エラー: %s", e)
+        raise
+
+    # チャンクごとの詳細は LOG_LEVEL=DEBUG か、LOG_DEBUG_SAMPLE で抽出されたリクエストだけ出力する
+    sampled = sample_debug()
+    for j, seg in enumerate(segments):
+        label = labels[predicted_indices[j]]
+
+        if sampled:
+            logger.debug("🎯 チャンク %ss ~ %ss 🏷️ %s 🔢 %s", seg["start"], seg["end"], label, predictions[j], extra=SAMPLED)
+
+        seg["label"] = label
+        seg["scores"] = [round(score, 6) for score in predictions[j].tolist()]
+
+# 録音を tempo / bar_count で8×bar_count個のチャンクに分割し、各チャンクの特徴量を抽出して分類する関数
+# CPU_POOL_WORKERS を指定した場合、特徴量抽出はプロセスプールで実行する（推論は全チャンクまとめて1回で行う）
+def classify_chunks(y_full, sr, tempo, bar_count, full_frames=None, onsets=None):
+    with stage("features"):
+        if cpu_pool.runs("rhythm"):
+            # whole モードのフレーム特徴量もワーカー側で計算する
+            results, rows = cpu_pool.run(rhythm_features_task, y_full, sr, tempo, bar_count, FEATURE_MODE, onsets)
+        else:
+            results, rows = chunk_feature_rows(y_full, sr, tempo, bar_count, full_frames, onsets)
+
+    classify_rows([results[i] for i, _ in rows], [features for _, features in rows])
+    return results
+
+# 推論結果（各チャンクのラベルとスコア）を再学習用のログに渡す関数
+# 書き込みは prediction_log のスレッドがまとめて行うため、リクエストは待たされない
+def log_predictions(segments, tempo, bar_count, request_id=None):
+    prediction_log.log(segments, request_id or new_request_id(), tempo, bar_count, rhythm_model_version())
+
+# 再分割用に保持する1録音分の中間結果（PCM と、whole モードでは録音全体のフレーム特徴量、
+# ONSET_SNAP=1 ではオンセット時刻）
+def new_rhythm_entry(y_full, sr):
+    # whole モードでは録音全体のフレーム特徴量を1度だけ計算しておく（プロセスプール使用時はワーカーが毎回計算する）
+    full_frames = None
+    if FEATURE_MODE == "whole" and not cpu_pool.runs("rhythm"):
+        with stage("features"):
+            full_frames = compute_frames(y_full, sr)
+    # オンセット検出はスナップを使う場合だけ行う（whole モードでは上の STFT を使い回す）
+    onsets = None
+    if ONSET_SNAP:
+        with stage("onset"):
+            onsets = onset_times(y_full, sr, full_frames)
+    return {"kind": "rhythm", "y": y_full, "frames": full_frames, "onsets": onsets}
+
+# 保持している録音を tempo / bar_count で分割して分類する
+def classify_entry(entry, tempo, bar_count):
+    return classify_chunks(entry["y"], SAMPLE_RATE, tempo, bar_count, entry["frames"], entry["onsets"])
+
 # /predict エンドポイント：音声ファイルを受け取り、チャンクごとに特徴量抽出と推論を行い、結果を返す
 @predict_bp.route("/predict", methods=["POST"])
 def predict():
@@ -121,102 +130,65 @@ def predict():
     tempo = float(request.form.get("tempo", 120))
     bar_count = int(request.form.get("bar_count", 1))
 
-    # アップロードされたファイルを一時的に保存し、webm形式からwav形式に変換
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp_webm:
-        file.save(tmp_webm.name)
-        webm_path = tmp_webm.name
+    data = file.read()
+
+    # 同じ録音・同じ設定の結果がキャッシュにあれば、デコードや推論を行わずに返す
+    key = cache_key("predict", data, rhythm_model_version(), tempo=tempo, bar_count=bar_count)
+    cached = result_cache.get(key)
+    if cached is not None:
+        logger.debug("♻️ キャッシュ済みの結果を返します")
+        # 同じ録音の再送信も再学習用のログには残す
+        log_predictions(cached["segments"], tempo, bar_count, request.headers.get("X-Request-ID"))
+        # 結果キャッシュは中間結果より長く残るため、ハンドルが破棄済みなら null にして返す
+        return jsonify(refresh_handle(cached))
 
-    wav_path = webm_path.replace(".webm", ".wav")
+    # 同じ録音の中間結果が残っていれば（テンポだけ変えた再送信など）、デコードせずに使い回す
+    handle = cache_key("predict-frames", data, FEATURE_MODE)
+    entry = analysis_store.get(handle)
 
     try:
-        # webm → wav に変換
-        ffmpeg.input(webm_path).output(wav_path).run(quiet=True, overwrite_output=True)
-
-        # 全体の音声を読み込み
-        y_full, sr = librosa.load(wav_path, sr=16000)
-
-        # 音声全体からオンセット（発音の始まり）を検出して時間情報を取得
-        onset_env = librosa.onset.onset_strength(y=y_full, sr=sr)
-        onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, backtrack=True)
-        onset_times = librosa.frames_to_time(onset_frames, sr=sr)
-
-        if len(onset_times) < 9:
-            duration = librosa.get_duration(y=y_full, sr=sr)
-            onset_times = list(onset_times) + [duration] * (9 - len(onset_times))
-        onset_times = onset_times[:9]
-
-        results = []
-
-        # テンポ情報に基づいて1小節×bar_countを8×bar_count個のチャンクに分割する設定
-        beat_duration = 60.0 / tempo
-        total_duration = beat_duration * 4 * bar_count
-        chunk_duration = total_duration / (8 * bar_count)
-
-        # 各チャンクについて特徴量を抽出し、推論を行う
-        for i in range(8 * bar_count):
-            nominal_start = i * chunk_duration
-            nominal_end = nominal_start + chunk_duration
-            # オンセットスナップを無効化
-            # search_start = max(0, nominal_start - chunk_duration / 2)
-            # search_end = nominal_start
-            # # スナップ対象となる onset を探索（前のみ）
-            # candidate_onsets = [t for t in onset_times if search_start <= t < search_end]
-            # if candidate_onsets:
-            #     onset = max(candidate_onsets)
-            #     shift = onset - nominal_start
-            # else:
-            #     shift = 0.0
-            # adjusted_start = nominal_start + shift
-            # adjusted_end = adjusted_start + chunk_duration
-            adjusted_start = nominal_start
-            adjusted_end = nominal_end
-            y_chunk = y_full[int(sr * adjusted_start):int(sr * adjusted_end)]
-            y_chunk = y_chunk[:int(len(y_chunk) * 0.9)]  # チャンクの末尾10%をカット（めり込み防止）
-
-            # 無音や音声が短すぎる場合は noise として扱う
-            if y_chunk.shape[0] == 0:
-                results.append({"label": "noise", "start": round(nominal_start, 2), "end": round(nominal_end, 2), "adjustedStart": round(adjusted_start, 4), "scores": [0,0,0,1]})
-                continue
-
-            feature_vector = extract_features(y_chunk, sr)
-            feature_vector = feature_vector.reshape(1, -1)
-
-            try:
-                # print("📐 特徴ベクトル shape:", feature_vector.shape)
-                # print("🔍 モデル expected input shape:", model.input_shape)
-                pred = model.predict(feature_vector)
-                predicted_index = np.argmax(pred[0])
-            except Exception as e:
-                print("❌ 推論エラー:", str(e))
-                raise
-
-            label = labels[predicted_index]
-
-            print(f"🎯 チャンク {i}: {round(adjusted_start,2)}s ~ {round(adjusted_end,2)}s")
-            print("    🔢 予測スコア:", pred[0])
-            print("    🏷️ 予測ラベル:", label)
-
-            results.append({
-                "label": label,
-                "start": round(nominal_start, 2),
-                "end": round(nominal_end, 2),
-                "adjustedStart": round(adjusted_start, 4),
-                "scores": [round(score, 6) for score in pred[0].tolist()]
-            })
-
-        # 推論結果をCSVログに保存
-        log_to_csv(results)
-        return jsonify({"segments": results})
+        sr = SAMPLE_RATE
+        if entry is None:
+            # アップロードされた音声をメモリ上で 16kHz モノラル PCM にデコード
+            # （ONSET_SNAP=1 の場合は、音声全体からオンセット（発音の始まり）も検出しておく）
+            y_full = decode_audio(data)
+            entry = new_rhythm_entry(y_full, sr)
+            analysis_store.put(handle, entry)
+
+        results = classify_entry(entry, tempo, bar_count)
+
+        # 推論結果をログに保存（X-Request-ID があればそれをリクエストIDとして記録）
+        log_predictions(results, tempo, bar_count, request.headers.get("X-Request-ID"))
+        result = {"segments": results, "handle": handle}
+        result_cache.put(key, result)
+        return jsonify(result)
     
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        print("🔥 エラー発生:", str(e))
+        logger.exception("🔥 エラー発生: %s", e)
         return jsonify({"error": str(e)}), 500
 
-    # 一時ファイルを削除して後処理
-    finally:
-        for path in [webm_path, wav_path]:
-            if os.path.exists(path):
-                os.remove(path)
+# /predict が返したハンドルと新しいテンポ情報を受け取り、保持している録音を再分割して分類するエンドポイント
+# 音声のデコードは行わず、whole モードでは録音全体のフレーム特徴量（STFT）も再計算しない
+@predict_bp.route("/predict/resegment", methods=["POST"])
+def resegment():
+    handle = request.form.get("handle")
+    tempo = float(request.form.get("tempo", 120))
+    bar_count = int(request.form.get("bar_count", 1))
+
+    entry = analysis_store.get(handle) if handle else None
+    if entry is None or entry["kind"] != "rhythm":
+        return jsonify({"error": "Unknown or expired handle, please upload the file again"}), 404
+
+    try:
+        results = classify_entry(entry, tempo, bar_count)
+        log_predictions(results, tempo, bar_count, request.headers.get("X-Request-ID"))
+        return jsonify({"segments": results, "handle": handle})
+    except Exception as e:
+        logger.exception("🔥 エラー発生: %s", e)
+        return jsonify({"error": str(e)}), 500
 
 
-__all__ = ["predict_bp"]
+__all__ = ["predict_bp", "batcher", "classify_chunks", "classify_entry", "classify_rows", "log_predictions"]
@@ -0,0 +1,170 @@
+# -----------------------------------------------
+# 推論結果のログ（再学習用）をバックグラウンドで CSV に書き込むライター
+# リクエストのスレッドはチャンクごとの行をキューに積むだけで返り、
+# 書き込みスレッドが PREDICTION_LOG_FLUSH_SECONDS ごとにまとめて追記する（リクエスト間で行が混ざらない）
+# ファイルが PREDICTION_LOG_MAX_BYTES を超えたら prediction_log.csv.1, .2, ... にずらし、
+# PREDICTION_LOG_BACKUPS 個より古いものは削除する
+# 各行にはリクエストID・テンポ・小節数・モデルのバージョンも記録する
+# -----------------------------------------------
+import atexit
+import csv
+import io
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from log_config import get_logger
+
+PREDICTION_LOG_PATH = os.getenv("PREDICTION_LOG_PATH", "./prediction_log.csv")
+PREDICTION_LOG_MAX_BYTES = int(os.getenv("PREDICTION_LOG_MAX_BYTES", 10 * 1024 * 1024))
+PREDICTION_LOG_BACKUPS = int(os.getenv("PREDICTION_LOG_BACKUPS", 5))
+PREDICTION_LOG_FLUSH_SECONDS = float(os.getenv("PREDICTION_LOG_FLUSH_SECONDS", 1.0))
+PREDICTION_LOG_QUEUE_SIZE = int(os.getenv("PREDICTION_LOG_QUEUE_SIZE", 10000))
+
+HEADER = [
+    "timestamp", "request_id", "tempo", "bar_count", "model_version",
+    "chunk", "start", "end", "kick", "snare", "hihat", "noise", "label",
+]
+
+logger = get_logger(__name__)
+
+
+def new_request_id():
+    """ログの行をリクエスト単位でまとめるためのID"""
+    return uuid.uuid4().hex
+
+
+class PredictionLog:
+    """推論結果の行をキューで受け取り、別スレッドでまとめて CSV に追記するライター"""
+
+    def __init__(self, path, max_bytes=PREDICTION_LOG_MAX_BYTES, backups=PREDICTION_LOG_BACKUPS,
+                 flush_seconds=PREDICTION_LOG_FLUSH_SECONDS, queue_size=PREDICTION_LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = max(0, backups)
+        self.flush_seconds = max(0.0, flush_seconds)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._checked_header = False
+
+        self._stats_lock = threading.Lock()
+        self._logged = 0
+        self._written = 0
+        self._dropped = 0
+        self._batches = 0
+        self._rotations = 0
+
+    def log(self, segments, request_id, tempo, bar_count, model_version):
+        """1リクエスト分のチャンクの結果を書き込み待ちに積む（キューが満杯なら捨てて、リクエストは待たせない）"""
+        timestamp = datetime.now().isoformat()
+        rows = [
+            [timestamp, request_id, tempo, bar_count, model_version,
+             f"chunk_{i}", seg["start"], seg["end"], *seg["scores"], seg["label"]]
+            for i, seg in enumerate(segments)
+        ]
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            with self._stats_lock:
+                self._dropped += len(rows)
+            return
+        with self._stats_lock:
+            self._logged += len(rows)
+
+    def flush(self, timeout=5.0):
+        """書き込み待ちの行をすべてファイルに書き出すまで待つ"""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="prediction-log", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # 書き込みに失敗しても（ディスク不足や不正な行など）スレッドは止めず、次のバッチの書き込みを続ける
+            try:
+                rows = [row for item in batch if not isinstance(item, threading.Event) for row in item]
+                if rows:
+                    self._write(rows)
+            except OSError as e:
+                logger.warning("⚠️ 推論ログの書き込みに失敗: %s", e)
+            except Exception as e:
+                logger.exception("🔥 推論ログの書き込みで予期しないエラー: %s", e)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write(self, rows):
+        # 列の違う古い形式のログは、追記せずにローテーションして新しいファイルにする
+        if not self._checked_header:
+            self._checked_header = True
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, newline="", encoding="utf-8") as f:
+                    if next(csv.reader(f), None) != HEADER:
+                        self._rotate()
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            writer.writerow(HEADER)
+        writer.writerows(rows)
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            f.write(buffer.getvalue())
+        with self._stats_lock:
+            self._written += len(rows)
+            self._batches += 1
+
+    def _rotate(self):
+        if self.backups == 0:
+            os.remove(self.path)
+        else:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        with self._stats_lock:
+            self._rotations += 1
+
+    def stats(self):
+        """受け付けた行数・書き込んだ行数・捨てた行数・書き込み回数・ローテーション回数を返す"""
+        with self._stats_lock:
+            return {
+                "path": self.path,
+                "pending": self._queue.qsize(),
+                "logged": self._logged,
+                "written": self._written,
+                "dropped": self._dropped,
+                "batches": self._batches,
+                "rotations": self._rotations,
+            }
+
+
+# アプリ全体で共有する推論ログ（終了時に書き込み待ちの行を書き出す）
+prediction_log = PredictionLog(PREDICTION_LOG_PATH)
+atexit.register(prediction_log.flush)
+
+__all__ = ["PredictionLog", "new_request_id", "prediction_log"]
@@ -0,0 +1,275 @@
+# -----------------------------------------------
+# 解析結果（/predict の segments、/pitch の pitch_series、/analyze の結果）のキャッシュ
+# アップロードされた音声のバイト列のハッシュと、エンドポイント・tempo・bar_count・
+# モデルのバージョンからキーを作り、同じ録音の再送信ではデコードや推論を行わずに結果を返す
+# ・メモリ上の LRU（RESULT_CACHE_SIZE 件まで、RESULT_CACHE_TTL 秒で失効）
+# ・RESULT_CACHE_DIR を指定した場合は、ディスク上にも JSON として保存する（再起動後も有効）
+#   ディスク上のファイルも、起動時と保存のたびの定期的な掃除で RESULT_CACHE_SIZE 件・RESULT_CACHE_TTL 秒までに保つ
+# RESULT_CACHE_SIZE=0 でキャッシュを無効化する
+# あわせて、テンポ変更時の再分割（/predict/resegment, /pitch/resegment）用に、
+# 直近の録音のフレーム単位の中間結果（PCM・特徴量フレーム・CREPE の出力）をハンドルで保持する
+# （メモリのみ、ANALYSIS_STORE_SIZE 件・ANALYSIS_STORE_MAX_BYTES バイト・ANALYSIS_STORE_TTL 秒まで）
+# キャッシュ済みの結果を返すときは、その結果が指すハンドルの中間結果を延命し、
+# 既に破棄されていればハンドルを null にして返す（refresh_handle）
+# -----------------------------------------------
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from log_config import get_logger
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 3600))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+ANALYSIS_STORE_SIZE = int(os.getenv("ANALYSIS_STORE_SIZE", 32))
+ANALYSIS_STORE_TTL = float(os.getenv("ANALYSIS_STORE_TTL", 1800))
+ANALYSIS_STORE_MAX_BYTES = int(os.getenv("ANALYSIS_STORE_MAX_BYTES", 512 * 1024 * 1024))
+
+# 書き込み途中の一時ファイルとみなす猶予（これより古い *.tmp は書き込みに失敗した残骸として削除する）
+TMP_GRACE_SECONDS = 60.0
+
+logger = get_logger(__name__)
+
+
+def cache_key(endpoint, data, version, **params):
+    """音声のバイト列・エンドポイント・モデルのバージョン・パラメータからキャッシュキーを作る"""
+    digest = hashlib.sha256(data).hexdigest()
+    meta = json.dumps({"endpoint": endpoint, "version": version, "params": params}, sort_keys=True)
+    return hashlib.sha256(f"{digest}:{meta}".encode()).hexdigest()
+
+
+def file_version(path):
+    """モデルファイルの名前・サイズ・更新時刻をバージョンとして返す（再学習で自動的に無効化される）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return os.path.basename(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+
+def _nbytes(value):
+    """値に含まれる NumPy 配列の合計バイト数（dict / list / tuple の中もたどる）"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class ResultCache:
+    """サイズと有効期限付きの LRU キャッシュ（任意でディスク上の JSON にも保存する）
+
+    directory を指定しない場合はメモリ上だけに保持するため、NumPy 配列などもそのまま保存できる
+    max_bytes を指定した場合は、保存した値に含まれる NumPy 配列の合計がそれを超えないよう古いものから破棄する
+    （最新の1件は、それだけで上限を超えていても保持する）
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, directory="", max_bytes=0):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = float(ttl)
+        self.max_bytes = max(0, int(max_bytes))
+        self.directory = directory or None
+        if self.directory and self.max_entries:
+            os.makedirs(self.directory, exist_ok=True)
+        # ディスク上のファイルを掃除する間隔（保存回数）。件数は最大でも上限の1.25倍程度に収まる
+        self._sweep_every = max(1, self.max_entries // 4)
+        self._writes_since_sweep = 0
+        self._sweep_lock = threading.Lock()
+
+        self._entries = OrderedDict()  # key -> (保存時刻, 結果, バイト数)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._disk_pruned = 0
+        if self.directory and self.max_entries:
+            self.prune_disk()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _expired(self, stored_at):
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """キャッシュ済みの結果を返す（なければ None）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[1]
+                self._remove(key)
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+            self._store(key, value, time.time())
+        return value
+
+    def touch(self, key):
+        """保存済みなら保存時刻と LRU の順序を更新して True を返す（ヒット・ミスには数えない）"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            if self._expired(entry[0]):
+                self._remove(key)
+                return False
+            self._entries[key] = (time.time(), entry[1], entry[2])
+            self._entries.move_to_end(key)
+            return True
+
+    def put(self, key, value):
+        """結果を保存する（ディスクにも保存する場合、value は JSON に変換できる dict）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._store(key, value, time.time())
+            self._writes_since_sweep += 1
+            sweep = self.directory is not None and self._writes_since_sweep >= self._sweep_every
+            if sweep:
+                self._writes_since_sweep = 0
+        self._write_disk(key, value)
+        if sweep:
+            self.prune_disk()
+
+    def _store(self, key, value, stored_at):
+        if key in self._entries:
+            self._remove(key)
+        size = _nbytes(value) if self.max_bytes else 0
+        self._entries[key] = (stored_at, value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes and self._bytes > self.max_bytes and len(self._entries) > 1
+        ):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.directory:
+            return
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("⚠️ 結果キャッシュの保存に失敗: %s", e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def prune_disk(self):
+        """ディスク上の期限切れ・上限超過（古い順）のファイルと、書き込みに失敗した一時ファイルを削除する"""
+        if not self.directory or not self._sweep_lock.acquire(blocking=False):
+            return 0  # 別のスレッドが掃除中
+        try:
+            now = time.time()
+            entries = []
+            removed = 0
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    try:
+                        mtime = item.stat().st_mtime
+                        if item.name.endswith(".tmp"):
+                            if now - mtime > TMP_GRACE_SECONDS:
+                                os.remove(item.path)
+                                removed += 1
+                        elif item.name.endswith(".json"):
+                            entries.append((mtime, item.path))
+                    except OSError:
+                        continue  # 他のスレッド・プロセスが先に削除した
+            entries.sort(reverse=True)
+            for i, (mtime, path) in enumerate(entries):
+                if i >= self.max_entries or self._expired(mtime):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+        except OSError as e:
+            logger.warning("⚠️ 結果キャッシュの掃除に失敗: %s", e)
+            return 0
+        finally:
+            self._sweep_lock.release()
+        if removed:
+            with self._lock:
+                self._disk_pruned += removed
+            logger.debug("🧹 結果キャッシュのファイルを %d 件削除", removed)
+        return removed
+
+    def stats(self):
+        """ヒット数・ミス数・保存件数を返す"""
+        with self._lock:
+            lookups = self._hits + self._disk_hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "disk": self.directory is not None,
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "disk_pruned": self._disk_pruned,
+                "hit_rate": (self._hits + self._disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+# アプリ全体で共有するキャッシュ
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DIR)
+
+# テンポ変更時の再分割用に、フレーム単位の中間結果をハンドルごとに保持するストア（メモリのみ）
+analysis_store = ResultCache(ANALYSIS_STORE_SIZE, ANALYSIS_STORE_TTL, max_bytes=ANALYSIS_STORE_MAX_BYTES)
+
+
+def refresh_handle(result):
+    """キャッシュ済みの結果が指すハンドルの中間結果を延命し、既に破棄されていればハンドルを None にした結果を返す"""
+    handle = result.get("handle")
+    if handle is None or analysis_store.touch(handle):
+        return result
+    return dict(result, handle=None)
+
+
+__all__ = ["ResultCache", "analysis_store", "cache_key", "file_version", "refresh_handle", "result_cache"]
@@ -0,0 +1,96 @@
+# -----------------------------------------------
+# リズム分類のチャンク分割と特徴量抽出（predict_api・stream_api・プロセスプールのワーカーで共通）
+# 録音を tempo / bar_count で8×bar_count個のチャンクに分割し、各チャンクの105次元の特徴ベクトルを求める
+# Flask やモデルレジストリ・結果キャッシュに依存しないため、ワーカーはこのモジュールだけを読み込めばよい
+# （ログはサーバー本体では log_config の設定で出力され、ワーカーでは出力されない）
+# -----------------------------------------------
+import logging
+
+import librosa
+import numpy as np
+
+from features import compute_frames, frame_range, pool_features, snap_to_onsets
+
+logger = logging.getLogger(f"micrie.{__name__}")
+
+
+# 音声信号から様々な音響特徴量を抽出して、1次元の特徴ベクトルとして返す関数
+# 拡張された特徴抽出関数
+def extract_features(y, sr):
+    # 無音判定: RMS最大値が閾値未満ならnoiseとみなす
+    rms = librosa.feature.rms(y=y)
+    logger.debug("🔍 RMS max: %s", np.max(rms))
+    if np.max(rms) < 0.007:
+        # print("🔇 無音と判断: noise特徴量を返します")
+        return np.zeros(105)
+
+    # 1回のSTFTから全特徴量を計算し、平均・標準偏差に集約
+    frames = compute_frames(y, sr, rms=rms)
+    feature_vector = pool_features(frames, layout="predict")
+    if feature_vector.shape[0] != 105:
+        logger.warning("⚠️ 特徴ベクトルの次元が不正です: %s", feature_vector.shape)
+    return feature_vector
+
+# 録音全体のフレーム特徴量から、チャンクに対応するフレーム範囲 [start, end) を集約する関数
+def pool_chunk_features(frames, start, end):
+    # 無音判定はチャンク単位の抽出と同じくRMS最大値で行う
+    rms_max = np.max(frames["rms"][:, start:end])
+    logger.debug("🔍 RMS max: %s", rms_max)
+    if rms_max < 0.007:
+        return np.zeros(105)
+    return pool_features(frames, start, end, layout="predict")
+
+# テンポ情報に基づいて1小節×bar_countを8×bar_count個のチャンクに分割したときのチャンク長[s]を返す関数
+def chunk_length(tempo, bar_count):
+    beat_duration = 60.0 / tempo
+    total_duration = beat_duration * 4 * bar_count
+    return total_duration / (8 * bar_count)
+
+# i 番目のチャンクの結果の雛形と特徴ベクトルを返す関数（音声が空のチャンクは noise と確定し、特徴ベクトルは None）
+# full_frames（録音全体のフレーム特徴量）を渡した場合は、チャンク範囲のフレームを集約する（FEATURE_MODE=whole）
+# adjusted_start（オンセットにスナップした開始時刻）を渡した場合は、そこから1チャンク分を解析する
+def chunk_features(y_full, sr, i, chunk_duration, full_frames=None, adjusted_start=None):
+    nominal_start = i * chunk_duration
+    nominal_end = nominal_start + chunk_duration
+    adjusted_start = nominal_start if adjusted_start is None else float(adjusted_start)
+    adjusted_end = adjusted_start + chunk_duration
+    y_chunk = y_full[int(sr * adjusted_start):int(sr * adjusted_end)]
+    y_chunk = y_chunk[:int(len(y_chunk) * 0.9)]  # チャンクの末尾10%をカット（めり込み防止）
+
+    # 無音や音声が短すぎる場合は noise として扱う
+    if y_chunk.shape[0] == 0:
+        return {"label": "noise", "start": round(nominal_start, 2), "end": round(nominal_end, 2), "adjustedStart": round(adjusted_start, 4), "scores": [0,0,0,1]}, None
+
+    if full_frames is not None:
+        start_sample = int(sr * adjusted_start)
+        start_frame, end_frame = frame_range(start_sample, start_sample + len(y_chunk), full_frames["S"].shape[1])
+        features = pool_chunk_features(full_frames, start_frame, end_frame)
+    else:
+        features = extract_features(y_chunk, sr)
+    # 推論結果は後でまとめて埋める
+    return {
+        "label": None,
+        "start": round(nominal_start, 2),
+        "end": round(nominal_end, 2),
+        "adjustedStart": round(adjusted_start, 4),
+        "scores": None
+    }, features
+
+# 録音を tempo / bar_count で8×bar_count個のチャンクに分割し、全チャンクの結果の雛形と
+# 推論が必要なチャンクの (番号, 特徴ベクトル) の一覧を返す関数（プロセスプールのワーカーでも実行する）
+# onsets（オンセット時刻）を渡した場合は、各チャンクの開始時刻を直前のオンセットにスナップする
+def chunk_feature_rows(y_full, sr, tempo, bar_count, full_frames=None, onsets=None):
+    chunk_duration = chunk_length(tempo, bar_count)
+    n_chunks = 8 * bar_count
+    starts = snap_to_onsets(onsets, chunk_duration, n_chunks) if onsets is not None else [None] * n_chunks
+    results = []
+    rows = []
+    for i in range(n_chunks):
+        seg, features = chunk_features(y_full, sr, i, chunk_duration, full_frames, starts[i])
+        results.append(seg)
+        if features is not None:
+            rows.append((i, features))
+    return results, rows
+
+
+__all__ = ["chunk_feature_rows", "chunk_features", "chunk_length", "extract_features", "pool_chunk_features"]
@@ -0,0 +1,310 @@
+# -----------------------------------------------
+# 録音中の音声を少しずつ受け取り、録音と並行して解析するストリーミングAPI
+# ・POST /stream/start           : セッションを開始（kind=predict / pitch、tempo、bar_count）
+# ・POST /stream/<id>/chunk      : 録音データの続き（MediaRecorder の断片）をリクエストボディで送る
+# ・POST /stream/<id>/finish     : 録音終了。残りを解析し、/predict・/pitch と同じ形式の結果を返す
+# セッションごとに ffmpeg を起動したままにして順次デコードし、
+# predict はチャンクの区間がデコードし終わった時点で特徴量抽出と分類を行い、
+# pitch はデコード済みの区間に CREPE をかけておく（最終的なチャンク分割は録音長が確定してから行う）
+#   Viterbi 平滑化を使う場合は、ワンショットの /pitch と同じく各フレームの前後に PITCH_GATE_PAD 秒の文脈が
+#   あるよう、デコード済みの末尾 PITCH_GATE_PAD 秒は確定させず、次の断片が届いてから後ろの文脈込みで計算し直す
+# 同時セッション数は STREAM_MAX_SESSIONS、無通信のセッションは STREAM_IDLE_TIMEOUT 秒で破棄する
+# （破棄は別スレッドで定期的に行うため、放置されたセッションの ffmpeg も次のリクエストを待たずに終了する）
+# 各セッションの ffmpeg は、ワンショットのデコードと同じ DECODER_CONCURRENCY の枠を1つ使う
+# -----------------------------------------------
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from flask import Blueprint, jsonify, request
+
+from audio_io import SAMPLE_RATE, DecoderBusy, StreamDecoder
+from log_config import get_logger
+from pitch_api import ensure_crepe_model, new_pitch_entry
+from pitch_core import CREPE_WINDOW, PITCH_GATE_PAD, PITCH_GATE_RMS, crepe_config, crepe_frames, run_crepe, segment_pitch
+from predict_api import FEATURE_MODE, ONSET_SNAP, classify_entry, classify_rows, log_predictions, new_rhythm_entry
+from rhythm_core import chunk_features, chunk_length
+from result_cache import analysis_store
+
+STREAM_MAX_SESSIONS = int(os.getenv("STREAM_MAX_SESSIONS", 8))
+STREAM_IDLE_TIMEOUT = float(os.getenv("STREAM_IDLE_TIMEOUT", 60))
+
+stream_bp = Blueprint("stream", __name__)
+logger = get_logger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# 同時セッション数の枠（開始時に確保し、終了・破棄で返す。ffmpeg の起動中も _sessions_lock を持たない）
+_capacity = threading.BoundedSemaphore(STREAM_MAX_SESSIONS)
+_reaper = None
+_stats = {"started": 0, "finished": 0, "expired": 0, "rejected": 0}
+
+
+# 1回の録音（ストリーミングセッション）分の状態
+class _StreamSession:
+    def __init__(self, kind, tempo, bar_count, config):
+        self.kind = kind
+        self.tempo = tempo
+        self.bar_count = bar_count
+        self.config = config
+        self.decoder = StreamDecoder(SAMPLE_RATE)
+        self.lock = threading.Lock()
+        self.touched = time.monotonic()
+
+        # predict: 確定したチャンクの結果（チャンク番号順）
+        self.segments = []
+        # pitch: 録音の先頭から計算済みの CREPE フレーム（周波数・信頼度・計算済みマスク）
+        # 断片ごとのブロックを溜めておき、録音終了時に1度だけ連結する
+        self.pitch_frames = 0
+        self.frequency = []
+        self.confidence = []
+        self.covered = []
+
+    # デコード済みの区間で確定したチャンクを解析する
+    def analyze(self, y):
+        if self.kind == "predict":
+            self._analyze_rhythm(y)
+        else:
+            ensure_crepe_model(self.config)
+            self._analyze_pitch(y)
+
+    # チャンクの区間がすべてデコード済みになったチャンクから特徴量を抽出して分類する
+    # final=True（録音終了時）は、録音が予定より短く区間が最後まで届かなかったチャンクも解析する
+    # （FEATURE_MODE=whole は録音全体の STFT を、ONSET_SNAP=1 は録音全体のオンセット検出を使うため、録音終了後にまとめて行う）
+    def _analyze_rhythm(self, y, final=False):
+        if FEATURE_MODE == "whole" or ONSET_SNAP:
+            return
+        chunk_duration = chunk_length(self.tempo, self.bar_count)
+        pending = []
+        features_list = []
+        for i in range(len(self.segments), 8 * self.bar_count):
+            if not final and len(y) < int(SAMPLE_RATE * (i + 1) * chunk_duration):
+                break
+            seg, features = chunk_features(y, SAMPLE_RATE, i, chunk_duration)
+            self.segments.append(seg)
+            if features is not None:
+                pending.append(seg)
+                features_list.append(features)
+        classify_rows(pending, features_list)
+
+    # 窓（1024サンプル）がすべてデコード済みになったフレームに CREPE をかけておく
+    # 無音の区間は飛ばし、録音終了後に判定に必要な分だけ crepe_frames で埋める
+    # Viterbi を使う場合、末尾の余白分のフレームは後ろの文脈がまだないため確定させない（次の断片で計算し直す）
+    def _analyze_pitch(self, y):
+        hop = int(SAMPLE_RATE * self.config["step_size"] / 1000)
+        pad = int(round(PITCH_GATE_PAD * 1000 / self.config["step_size"]))
+        done = self.pitch_frames
+        ready = (len(y) - CREPE_WINDOW // 2) // hop + 1 if len(y) >= CREPE_WINDOW // 2 else 0
+        commit = ready - pad if self.config["viterbi"] else ready
+        if commit <= done:
+            return
+
+        frequency = np.zeros(commit - done)
+        confidence = np.zeros(commit - done, dtype=np.float32)
+        covered = np.zeros(commit - done, dtype=bool)
+        span = y[max(0, done * hop - CREPE_WINDOW // 2):(commit - 1) * hop + CREPE_WINDOW // 2]
+        if np.sqrt(np.mean(np.square(span, dtype=np.float64))) >= PITCH_GATE_RMS:
+            # center=True と同じく先頭に無音を足した音声から切り出し、前後に余白（Viterbi の文脈）を付けて実行
+            run_start = max(0, done - pad)
+            # （録音全体はコピーせず、必要な区間だけを切り出して先頭の無音を足す）
+            start = run_start * hop - CREPE_WINDOW // 2
+            span_audio = y[max(0, start):(ready - 1) * hop + CREPE_WINDOW // 2]
+            if start < 0:
+                span_audio = np.concatenate([np.zeros(-start, dtype=y.dtype), span_audio])
+            span_frequency, span_confidence = run_crepe(span_audio, SAMPLE_RATE, self.config, center=False)
+            frequency[:] = span_frequency[done - run_start:commit - run_start]
+            confidence[:] = span_confidence[done - run_start:commit - run_start]
+            covered[:] = True
+
+        self.frequency.append(frequency)
+        self.confidence.append(confidence)
+        self.covered.append(covered)
+        self.pitch_frames = commit
+
+    # 録音全体のPCMから最終結果を作り、再分割用の中間結果をハンドルで保存する
+    def result(self, y, handle):
+        if self.kind == "predict":
+            entry = new_rhythm_entry(y, SAMPLE_RATE)
+            if FEATURE_MODE == "whole" or ONSET_SNAP:
+                results = classify_entry(entry, self.tempo, self.bar_count)
+            else:
+                self._analyze_rhythm(y, final=True)
+                results = self.segments
+            analysis_store.put(handle, entry)
+            log_predictions(results, self.tempo, self.bar_count, handle)
+            return {"segments": results, "handle": handle}
+
+        # 録音長が確定したので、計算済みのフレームを全体の配列に移し、判定に必要な残りのフレームだけ CREPE を実行
+        ensure_crepe_model(self.config)
+        entry = new_pitch_entry(y, self.config)
+        hop = int(SAMPLE_RATE * self.config["step_size"] / 1000)
+        n_frames = 1 + len(y) // hop
+        done = min(self.pitch_frames, n_frames)
+        frames = {
+            "frequency": np.zeros(n_frames),
+            "confidence": np.zeros(n_frames, dtype=np.float32),
+            "covered": np.zeros(n_frames, dtype=bool),
+        }
+        for name in ("frequency", "confidence", "covered"):
+            blocks = getattr(self, name)
+            if blocks:
+                frames[name][:done] = np.concatenate(blocks)[:done]
+        entry["frames"] = crepe_frames(y, SAMPLE_RATE, self.config, self.tempo, self.bar_count, frames)
+        analysis_store.put(handle, entry)
+        segments = segment_pitch(y, SAMPLE_RATE, frames["frequency"], frames["confidence"], self.tempo, self.bar_count)
+        return {"pitch_series": segments, "handle": handle}
+
+
+# 無通信のまま STREAM_IDLE_TIMEOUT 秒を過ぎたセッションを破棄する（ffmpeg の終了はロックの外で行う）
+def _expire_sessions():
+    now = time.monotonic()
+    with _sessions_lock:
+        expired = [(sid, s) for sid, s in _sessions.items() if now - s.touched > STREAM_IDLE_TIMEOUT]
+        for sid, _ in expired:
+            del _sessions[sid]
+            _stats["expired"] += 1
+    for sid, session in expired:
+        _close(session)
+        logger.info("⌛ ストリーミングセッションを破棄: %s", sid)
+
+
+# 期限切れのセッションを定期的に破棄するスレッド（最初のセッション開始時に起動する）
+def _reap_sessions():
+    while True:
+        time.sleep(max(1.0, STREAM_IDLE_TIMEOUT / 4))
+        try:
+            _expire_sessions()
+        except Exception as e:
+            logger.exception("❌ ストリーミングセッションの破棄に失敗: %s", e)
+
+
+def _ensure_reaper():
+    global _reaper
+    with _sessions_lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap_sessions, name="stream-reaper", daemon=True)
+            _reaper.start()
+
+
+def _get_session(session_id):
+    _expire_sessions()
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        if session is not None:
+            session.touched = time.monotonic()
+        return session
+
+
+# セッションを開始するエンドポイント
+@stream_bp.route("/stream/start", methods=["POST"])
+def start_stream():
+    kind = request.form.get("kind", "predict")
+    if kind not in ("predict", "pitch"):
+        return jsonify({"error": f"unknown kind: {kind}"}), 400
+    tempo = float(request.form.get("tempo", 120))
+    bar_count = int(request.form.get("bar_count", 1))
+
+    _expire_sessions()
+    if not _capacity.acquire(blocking=False):
+        with _sessions_lock:
+            _stats["rejected"] += 1
+        return jsonify({"error": "too many streaming sessions, please retry later"}), 503
+
+    # ffmpeg の起動は _sessions_lock の外で行い、他のセッションの送信を待たせない
+    try:
+        session = _StreamSession(kind, tempo, bar_count, crepe_config(request.form))
+    except DecoderBusy as e:
+        _capacity.release()
+        with _sessions_lock:
+            _stats["rejected"] += 1
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        _capacity.release()
+        logger.exception("❌ ストリーミングセッションの開始に失敗: %s", e)
+        return jsonify({"error": "Failed to start decoder"}), 500
+
+    session_id = uuid.uuid4().hex
+    with _sessions_lock:
+        _sessions[session_id] = session
+        _stats["started"] += 1
+    _ensure_reaper()
+    logger.info("🎙️ ストリーミングセッション開始: %s (%s)", session_id, kind)
+    return jsonify({"session": session_id}), 200
+
+
+# 録音データの続きを受け取り、確定したチャンクを解析するエンドポイント
+@stream_bp.route("/stream/<session_id>/chunk", methods=["POST"])
+def push_stream(session_id):
+    session = _get_session(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+
+    with session.lock:
+        try:
+            session.decoder.feed(request.get_data())
+            y = session.decoder.pcm()
+            session.analyze(y)
+        except Exception as e:
+            logger.exception("🔥 ストリーミング解析でエラー: %s", e)
+            _discard(session_id)
+            return jsonify({"error": str(e)}), 500
+
+        progress = {"session": session_id, "decoded_seconds": round(len(y) / SAMPLE_RATE, 3)}
+        if session.kind == "predict":
+            progress["segments"] = session.segments
+        else:
+            progress["analyzed_seconds"] = round(session.pitch_frames * session.config["step_size"] / 1000, 3)
+        return jsonify(progress), 200
+
+
+# 録音終了を受け取り、最終的な解析結果を返すエンドポイント（残りのデータはボディで一緒に送ってもよい）
+@stream_bp.route("/stream/<session_id>/finish", methods=["POST"])
+def finish_stream(session_id):
+    session = _get_session(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+
+    with session.lock:
+        try:
+            data = request.get_data()
+            if data:
+                session.decoder.feed(data)
+            y = session.decoder.finish()
+            result = session.result(y, session_id)
+        except Exception as e:
+            logger.exception("🔥 ストリーミング解析でエラー: %s", e)
+            return jsonify({"error": str(e)}), 500
+        finally:
+            _discard(session_id)
+
+    with _sessions_lock:
+        _stats["finished"] += 1
+    logger.info("✅ ストリーミングセッション終了: %s", session_id)
+    return jsonify(result), 200
+
+
+def _discard(session_id):
+    with _sessions_lock:
+        session = _sessions.pop(session_id, None)
+    if session is not None:
+        _close(session)
+
+
+# セッションの ffmpeg を終了し、同時セッション数の枠を返す（_sessions から取り除いたセッションに1度だけ呼ぶ）
+def _close(session):
+    try:
+        session.decoder.close()
+    finally:
+        _capacity.release()
+
+
+def stream_stats():
+    """ストリーミングセッションの数と累計（開始・終了・期限切れ・拒否）を返す"""
+    with _sessions_lock:
+        return dict(_stats, active=len(_sessions), max_sessions=STREAM_MAX_SESSIONS)
+
+
+__all__ = ["stream_bp", "stream_stats"]
@@ -0,0 +1,39 @@
+# -----------------------------------------------
+# 特徴量エンジン（features.py）の一致テスト
+# 推論（predict）・学習（train）両方のレイアウトについて、pool_features の105次元ベクトルが
+# 以前の librosa 個別呼び出し版（bench_features の基準実装）と許容誤差内で一致することを確かめる
+# 使い方: python -m pytest -q test_features.py
+# -----------------------------------------------
+import numpy as np
+import pytest
+
+from bench_features import ATOL, REFERENCES, RTOL, SR
+from features import FEATURE_DIM, compute_frames, pool_features
+
+
+# キック/ハイハット/声風の合成音（学習レイアウトの ΔMFCC に必要なフレーム数を満たす長さ）
+def synth_chunks(duration=0.5):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(SR * duration)) / SR
+    kick = np.sin(2 * np.pi * 60 * t) * np.exp(-t * 20)
+    hihat = rng.standard_normal(len(t)) * np.exp(-t * 60) * 0.3
+    voice = 0.2 * np.sin(2 * np.pi * 220 * t) + 0.01 * rng.standard_normal(len(t))
+    return {"kick": kick, "hihat": hihat, "voice": voice}
+
+
+CHUNKS = {name: y.astype(np.float32) for name, y in synth_chunks().items()}
+
+
+@pytest.mark.parametrize("layout", sorted(REFERENCES))
+@pytest.mark.parametrize("name", sorted(CHUNKS))
+def test_pool_features_matches_reference(layout, name):
+    y = CHUNKS[name]
+    expected = REFERENCES[layout](y, SR)
+    actual = pool_features(compute_frames(y, SR), layout=layout)
+    assert actual.shape == (FEATURE_DIM,)
+    np.testing.assert_allclose(actual, expected, rtol=RTOL, atol=ATOL)
+
+
+def test_unknown_layout():
+    with pytest.raises(ValueError):
+        pool_features(compute_frames(CHUNKS["kick"], SR), layout="unknown")
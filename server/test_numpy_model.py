@@ -0,0 +1,44 @@
+# -----------------------------------------------
+# NumPy 推論バックエンド（numpy_model.py）の一致テスト
+# コミット済みの model/micrie_model.npz が model/micrie_model.keras と同じ出力になることを確かめる
+# （学習し直した後に .npz を書き出し忘れた場合もここで検出できる）
+# Keras が入っていない環境では Keras との比較をスキップする
+# 使い方: python -m pytest -q test_numpy_model.py
+# -----------------------------------------------
+import numpy as np
+import pytest
+
+from features import FEATURE_DIM
+from numpy_model import DEFAULT_KERAS_PATH, DEFAULT_NPZ_PATH, PARITY_ATOL, NumpyDenseModel, check_parity
+
+N_CLASSES = 4
+
+
+# 固定の特徴ベクトル（無音時の0ベクトルと、実際の特徴量に近い大きさのランダムな行）
+def feature_rows(n_rows=64, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n_rows, FEATURE_DIM)) * 10
+    x[0] = 0
+    return x.astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def numpy_model():
+    return NumpyDenseModel.load(DEFAULT_NPZ_PATH)
+
+
+def test_npz_shape(numpy_model):
+    assert numpy_model.input_shape == (None, FEATURE_DIM)
+    scores = numpy_model.predict(feature_rows())
+    assert scores.shape == (64, N_CLASSES)
+    np.testing.assert_allclose(scores.sum(axis=1), 1.0, rtol=1e-5)
+
+
+def test_matches_keras(numpy_model):
+    keras = pytest.importorskip("keras")
+    keras_model = keras.models.load_model(DEFAULT_KERAS_PATH)
+    x = feature_rows()
+    diff = float(np.max(np.abs(keras_model.predict(x, verbose=0) - numpy_model.predict(x))))
+    assert diff <= PARITY_ATOL
+    # 書き出し時の確認（check_parity）と同じ入力でも一致する
+    assert check_parity(keras_model, numpy_model) <= PARITY_ATOL
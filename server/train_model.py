@@ -2,79 +2,37 @@
 # オーディオファイルから特徴量を抽出し、
 # KICK / SNARE / HIHAT / NOISE を分類する機械学習モデルを学習・保存
 # また、学習済みモデルを用いた8分割予測関数も含む
+# 特徴量抽出（ピッチシフトによる拡張を含む）はプロセスプールで並列に実行し、
+# ファイルごとの結果を特徴量ストア（FEATURE_STORE_DIR、feature_store.py）に追記する
+# （キー: ファイルのハッシュ・ラベル・FEATURE_VERSION）
+# サンプルを追加して再学習する場合は、新しいファイルだけが特徴量抽出される
+# 学習時は特徴量をメモリマップで読むため、データセット全体をメモリに載せない
+# 使い方: python train_model.py [--workers N] [--store ディレクトリ]
 # -----------------------------------------------
+import argparse
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-import tensorflow as tf
 import librosa
-from sklearn.model_selection import train_test_split
+from features import FEATURE_DIM, compute_frames, onset_times, pool_features, snap_to_onsets
+from feature_store import FeatureStore
+from numpy_model import NumpyDenseModel, check_parity, export_npz
 
 DATASET_DIR = "./dataset"
 CATEGORIES = ["kick", "snare", "hihat", "noise"]
+FEATURE_STORE_DIR = os.getenv("FEATURE_STORE_DIR", "./feature_store")
+PITCH_SHIFT_STEPS = (-2, 2)
+# 特徴量の計算方法・拡張方法を変えたら更新する（古い特徴量は学習に使われなくなる）
+FEATURE_VERSION = f"1:dim{FEATURE_DIM}:shift{','.join(map(str, PITCH_SHIFT_STEPS))}"
 
 # オーディオ波形 y から各種音響特徴量を抽出してベクトル化する関数
 def extract_features_from_y(y, sr):
     # チャンクの末尾10%をカット（発音のめり込み対策）
     y = y[:int(len(y) * 0.9)]
-    # MFCCとそのデルタ
-    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-    delta_mfccs = librosa.feature.delta(mfccs)
-
-    # 音響的特徴量
-    zcr = librosa.feature.zero_crossing_rate(y)
-    rms = librosa.feature.rms(y=y)
-    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
-    bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
-    flatness = librosa.feature.spectral_flatness(y=y)
-    rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
-    contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
-
-    # スペクトルフラックス: 周波数成分の時間変化
-    S = np.abs(librosa.stft(y))
-    spectral_flux = np.sqrt(np.mean(np.diff(S, axis=1)**2))
-
-    # クロマ特徴量: 高さ情報を圧縮して12次元で表現
-    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-
-    # 高域エネルギー（hihat対策）: 4000Hz以上の帯域のパワー比
-    freqs = librosa.fft_frequencies(sr=sr)
-    high_freq_mask = freqs >= 4000
-    high_energy = np.mean(S[high_freq_mask, :])
-    total_energy = np.mean(S)
-    high_energy_ratio = high_energy / (total_energy + 1e-6)  # 0割防止
-
-    # 低域エネルギー（kick補強用）: 0〜250Hz帯域
-    low_freq_mask = freqs <= 250
-    low_energy = np.mean(S[low_freq_mask, :])
-    low_energy_ratio = low_energy / (total_energy + 1e-6)
-
-    # 平均・標準偏差等でベクトル化
-    features = np.concatenate([
-        np.mean(mfccs, axis=1),
-        np.std(mfccs, axis=1),
-        np.mean(delta_mfccs, axis=1),
-        np.std(delta_mfccs, axis=1),
-        np.mean(zcr, axis=1),
-        np.std(zcr, axis=1),
-        np.mean(rms, axis=1),
-        np.std(rms, axis=1),
-        np.mean(centroid, axis=1),
-        np.std(centroid, axis=1),
-        np.mean(bandwidth, axis=1),
-        np.std(bandwidth, axis=1),
-        np.mean(flatness, axis=1),
-        np.std(flatness, axis=1),
-        np.mean(rolloff, axis=1),
-        np.std(rolloff, axis=1),
-        np.mean(contrast, axis=1),
-        np.std(contrast, axis=1),
-        np.array([high_energy_ratio]).flatten(),
-        np.array([spectral_flux]).flatten(),
-        np.array([low_energy_ratio]).flatten(),  # ★ 追加
-        np.mean(chroma, axis=1),
-        np.std(chroma, axis=1)
-    ])
-    return features
+    # 1回のSTFTから全特徴量を計算し、平均・標準偏差等でベクトル化
+    frames = compute_frames(y, sr)
+    return pool_features(frames, layout="train")
 
 # 指定された音声ファイルから特徴量を抽出するラッパー関数
 def extract_features(file_path):
@@ -82,80 +40,140 @@ def extract_features(file_path):
     y, sr = librosa.load(file_path, sr=16000)
     return extract_features_from_y(y, sr)
 
-X, y = [], []
-
-# データセット内の各カテゴリについて、音声ファイルから特徴量を抽出して学習データを構築
-for idx, label in enumerate(CATEGORIES):
-    label_dir = os.path.join(DATASET_DIR, label)
-    if not os.path.isdir(label_dir):
-        print(f"⚠️ ディレクトリが存在しません: {label_dir}")
-        continue
-    for fname in os.listdir(label_dir):
-        if fname.endswith(".wav"):
+# 1ファイル分の学習データ（元の音声とピッチシフト拡張の特徴ベクトル）を (行数, 105) で返す関数
+# プロセスプールのワーカーで実行する
+def file_features(path, label):
+    print(f"📂 特徴抽出中: {path}")
+    y_audio, sr = librosa.load(path, sr=16000)
+    rms_max = np.max(librosa.feature.rms(y=y_audio))
+    # RMS（音量）が小さい場合は無音と判定し、noiseとして扱う（拡張はスキップ）
+    if label == "kick" and rms_max < 0.007:
+        print("🔇 Kick無音と判断 → noise特徴量")
+        return np.zeros((1, 105))
+    elif rms_max < 0.01:
+        print("🔇 無音と判断 → noise特徴量")
+        return np.zeros((1, 105))
+    rows = [extract_features_from_y(y_audio, sr)]
+    # ピッチシフトによるデータ拡張（±2音）
+    for n_steps in PITCH_SHIFT_STEPS:
+        try:
+            y_shifted = librosa.effects.pitch_shift(y_audio, sr=sr, n_steps=n_steps)
+            rows.append(extract_features_from_y(y_shifted, sr))
+        except Exception as e:
+            print(f"⚠️ pitch shift エラー（{path}, {n_steps}）: {e}")
+    return np.stack(rows)
+
+# ファイルの内容・ラベル・FEATURE_VERSION から特徴量ストアのキーを決める
+def file_key(path, label):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(f"|{label}|{FEATURE_VERSION}".encode())
+    return digest.hexdigest()
+
+# データセット内の (パス, ラベル番号) の一覧を返す
+def list_dataset(dataset_dir=DATASET_DIR):
+    files = []
+    for idx, label in enumerate(CATEGORIES):
+        label_dir = os.path.join(dataset_dir, label)
+        if not os.path.isdir(label_dir):
+            print(f"⚠️ ディレクトリが存在しません: {label_dir}")
+            continue
+        for fname in os.listdir(label_dir):
             path = os.path.join(label_dir, fname)
-            print(f"📂 特徴抽出中: {path}")
-            if not os.path.isfile(path):
-                continue
-            try:
-                y_audio, sr = librosa.load(path, sr=16000)
-                rms_max = np.max(librosa.feature.rms(y=y_audio))
-                # RMS（音量）が小さい場合は無音と判定し、noiseとして扱う
-                if label == "kick" and rms_max < 0.007:
-                    print("🔇 Kick無音と判断 → noise特徴量")
-                    features = np.zeros(105)
-                    X.append(features)
-                    y.append(idx)
+            if fname.endswith(".wav") and os.path.isfile(path):
+                files.append((path, idx))
+    return files
+
+# データセットの特徴量を特徴量ストアに揃え、(ストア, 学習に使う行番号, ラベル) を返す
+# ストアにないファイルだけを並列に抽出し、終わったものから追記する（中断しても再実行で続きから抽出できる）
+def build_dataset(dataset_dir=DATASET_DIR, workers=None, store_dir=FEATURE_STORE_DIR):
+    store = FeatureStore(store_dir)
+    files = list_dataset(dataset_dir)
+    keys = [file_key(path, CATEGORIES[idx]) for path, idx in files]
+
+    missing = [i for i, key in enumerate(keys) if key not in store]
+    print(f"📦 特徴量ストア: {len(files) - len(missing)} / {len(files)} ファイル（新規抽出 {len(missing)} ファイル）")
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(file_features, files[i][0], CATEGORIES[files[i][1]]): i for i in missing}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    print(f"❌ エラー {files[i][0]}: {e}")
                     continue
-                elif rms_max < 0.01:
-                    print("🔇 無音と判断 → noise特徴量")
-                    features = np.zeros(105)
-                    X.append(features)
-                    y.append(idx)
-                    continue  # 拡張はスキップ
-                features = extract_features_from_y(y_audio, sr)
-                X.append(features)
-                y.append(idx)
-                # ピッチシフトによるデータ拡張（±2音）
-                for n_steps in [-2, 2]:
-                    try:
-                        y_shifted = librosa.effects.pitch_shift(y_audio, sr=sr, n_steps=n_steps)
-                        features_shifted = extract_features_from_y(y_shifted, sr)
-                        X.append(features_shifted)
-                        y.append(idx)
-                    except Exception as e:
-                        print(f"⚠️ pitch shift エラー（{path}, {n_steps}）: {e}")
-            except Exception as e:
-                print(f"❌ エラー {path}: {e}")
-
-X = np.array(X)
-y = np.array(y)
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
-
-# シンプルな3層の全結合ニューラルネットワークモデルを構築
-model = tf.keras.models.Sequential([
-    tf.keras.layers.Input(shape=(X.shape[1],)),
-    tf.keras.layers.Dense(64, activation='relu'),
-    tf.keras.layers.Dense(32, activation='relu'),
-    tf.keras.layers.Dense(len(CATEGORIES), activation='softmax')
-])
-
-# モデルの最適化手法と損失関数、評価指標を設定
-model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
-
-# バリデーション損失が改善しなくなった場合に早期終了するコールバックを設定
-early_stop = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=3, restore_best_weights=True)
-
-# モデルの学習を実行（バリデーションデータ付き）
-model.fit(X_train, y_train, epochs=30, batch_size=16, validation_data=(X_test, y_test), callbacks=[early_stop])
-
-# テストデータで学習済みモデルの性能を評価
-test_loss, test_acc = model.evaluate(X_test, y_test)
-print(f"🧪 テスト精度: {test_acc:.4f}")
-
-# モデル保存用のディレクトリを作成（既に存在する場合はスキップ）
-os.makedirs("./model", exist_ok=True)
-model.save("./model/micrie_model.keras")
-print("✅ モデル保存完了: ./model/micrie_model.keras")
+                store.append(keys[i], files[i][1], rows, path=files[i][0])
+
+    indices, labels = store.select(keys)
+    return store, indices, labels
+
+# モデルを学習し、Keras 形式と NumPy 形式（.npz）で保存する
+# 特徴量はメモリマップした行列から、バッチごとに必要な行だけを読み出す
+def train(matrix, indices, labels, batch_size=16):
+    import tensorflow as tf
+    from sklearn.model_selection import train_test_split
+
+    # 行番号で学習用・評価用に分割する（行列そのものはコピーしない）
+    train_idx, test_idx, y_train, y_test = train_test_split(indices, labels, test_size=0.2)
+
+    class MemmapSequence(tf.keras.utils.Sequence):
+        def __init__(self, rows, targets, shuffle):
+            super().__init__()
+            self.rows, self.targets, self.shuffle = rows, targets, shuffle
+            self.order = np.arange(len(rows))
+
+        def __len__(self):
+            return int(np.ceil(len(self.rows) / batch_size))
+
+        def __getitem__(self, i):
+            batch = self.order[i * batch_size:(i + 1) * batch_size]
+            rows = self.rows[batch]
+            # メモリマップからは昇順に読み出す
+            sort = np.argsort(rows)
+            return np.asarray(matrix[rows[sort]]), self.targets[batch][sort]
+
+        def on_epoch_end(self):
+            if self.shuffle:
+                np.random.shuffle(self.order)
+
+    train_data = MemmapSequence(train_idx, y_train, shuffle=True)
+    test_data = MemmapSequence(test_idx, y_test, shuffle=False)
+    train_data.on_epoch_end()
+
+    # シンプルな3層の全結合ニューラルネットワークモデルを構築
+    model = tf.keras.models.Sequential([
+        tf.keras.layers.Input(shape=(matrix.shape[1],)),
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(32, activation='relu'),
+        tf.keras.layers.Dense(len(CATEGORIES), activation='softmax')
+    ])
+
+    # モデルの最適化手法と損失関数、評価指標を設定
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+
+    # バリデーション損失が改善しなくなった場合に早期終了するコールバックを設定
+    early_stop = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=3, restore_best_weights=True)
+
+    # モデルの学習を実行（バリデーションデータ付き）
+    model.fit(train_data, epochs=30, validation_data=test_data, callbacks=[early_stop])
+
+    # テストデータで学習済みモデルの性能を評価
+    test_loss, test_acc = model.evaluate(test_data)
+    print(f"🧪 テスト精度: {test_acc:.4f}")
+
+    # モデル保存用のディレクトリを作成（既に存在する場合はスキップ）
+    os.makedirs("./model", exist_ok=True)
+    model.save("./model/micrie_model.keras")
+    print("✅ モデル保存完了: ./model/micrie_model.keras")
+
+    # TensorFlow なしで推論できるよう、重みを NumPy 形式（.npz）でも書き出して出力の一致を確認
+    export_npz(model, "./model/micrie_model.npz")
+    parity = check_parity(model, NumpyDenseModel.load("./model/micrie_model.npz"))
+    print(f"✅ NumPy 形式で保存: ./model/micrie_model.npz（Keras との最大絶対誤差: {parity:.3e}）")
+    return model
 
 # 指定ファイルをテンポに基づいて8分割し、それぞれに対して推論を実行
 def predict(file_path, model, tempo):
@@ -163,26 +181,16 @@ def predict(file_path, model, tempo):
     total_duration = 60.0 / tempo * 4
     chunk_duration = total_duration / 8
 
-    onset_env = librosa.onset.onset_strength(y=y_full, sr=sr)
-    onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, backtrack=True)
-    onset_times = librosa.frames_to_time(onset_frames, sr=sr)
+    # チャンクの開始位置を、近傍のonset（発音開始）にスナップして調整
+    # スナップ対象はチャンク先頭より前（±0.5チャンク内）のonsetのみに限定
+    snapped_starts = snap_to_onsets(onset_times(y_full, sr), chunk_duration, 8)
 
     features_list = []
     adjusted_starts = []
     results = []
     for i in range(8):
         chunk_start = i * chunk_duration
-        search_start = chunk_start - 0.5 * chunk_duration
-        # スナップ対象はチャンク先頭より前（±0.5チャンク内）のonsetのみに限定
-        candidate_onsets = [onset for onset in onset_times if search_start <= onset < chunk_start]
-
-        # チャンクの開始位置を、近傍のonset（発音開始）にスナップして調整
-        if candidate_onsets:
-            onset = max(candidate_onsets)
-            shift = onset - chunk_start
-            adjusted_start = chunk_start + shift
-        else:
-            adjusted_start = chunk_start
+        adjusted_start = float(snapped_starts[i])
 
         adjusted_end = adjusted_start + chunk_duration
         y_chunk = y_full[int(sr * adjusted_start) : int(sr * adjusted_end)]
@@ -228,4 +236,18 @@ def predict(file_path, model, tempo):
                 "scores": [round(score, 6) for score in predictions[j].tolist()]
             })
             j += 1
-    return results
\ No newline at end of file
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Micrie rhythm classifier training")
+    parser.add_argument("--dataset", default=DATASET_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="特徴量抽出のプロセス数（省略時はCPUコア数）")
+    parser.add_argument("--store", default=FEATURE_STORE_DIR, help="特徴量ストアのディレクトリ")
+    args = parser.parse_args()
+
+    store, indices, labels = build_dataset(args.dataset, args.workers, args.store)
+    train(store.matrix(), indices, labels)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,98 @@
 # Whisperモデルを用いた音声解析API
 # ・音声全体をテキスト化するエンドポイント（/analyze_whisper）
 # ・音声を8分割してキック/スネア/ハイハットを推定するエンドポイント（/analyze）
-# FlaskのBlueprintを使用し、ffmpegによる変換と一時ファイル処理を含む
+#   （全チャンクのメルスペクトログラムをまとめて1回の decode で処理）
+# FlaskのBlueprintを使用し、ffmpegによるメモリ上でのデコード処理を含む
 # -----------------------------------------------
 from flask import Blueprint, request, jsonify
 import os
-import whisper
-import tempfile
-import ffmpeg
+import numpy as np
+from audio_io import SAMPLE_RATE, DecoderBusy, decode_audio
+from log_config import get_logger
+from model_registry import models
+from metrics import stage
+from result_cache import cache_key, result_cache
 
 whisper_bp = Blueprint("whisper", __name__)
-
-print("🔄 Whisper モデル読み込み中...")
-# Whisperモデル（tiny）を読み込み、推論に備える
-whisper_model = whisper.load_model("tiny")
-print("✅ Whisper モデル読み込み完了")
+logger = get_logger(__name__)
+
+# Whisperモデル（既定は tiny）をモデルレジストリに登録（読み込みはレジストリが1度だけ行う）
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "tiny")
+
+# torch / whisper は起動を軽くするため、初回利用時にインポートする
+def load_whisper_model():
+    import whisper
+    return whisper.load_model(WHISPER_MODEL)
+
+def warmup_whisper_model(model):
+    import whisper
+    mel = whisper.log_mel_spectrogram(np.zeros(whisper.audio.N_SAMPLES, dtype=np.float32), n_mels=model.dims.n_mels)
+    whisper.decode(model, mel.to(model.device), whisper.DecodingOptions(language="ja", fp16=model.device.type == "cuda"))
+
+models.register("whisper", load_whisper_model, warmup=warmup_whisper_model)
+
+# /analyze で1回の decode にまとめるチャンク数の上限（メモリ使用量の調整用）
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", 16))
+
+# PCMチャンクを30秒に揃えたメルスペクトログラムにしてバッチでWhisperに通し、各チャンクのテキストを返す
+def transcribe_chunks(chunks):
+    import torch
+    import whisper
+    whisper_model = models.get("whisper")
+    options = whisper.DecodingOptions(language="ja", fp16=whisper_model.device.type == "cuda")
+    n_mels = whisper_model.dims.n_mels
+    texts = []
+    for b in range(0, len(chunks), WHISPER_BATCH_SIZE):
+        mels = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(np.asarray(chunk, dtype=np.float32)), n_mels=n_mels)
+            for chunk in chunks[b:b + WHISPER_BATCH_SIZE]
+        ]).to(whisper_model.device)
+        results = whisper.decode(whisper_model, mels, options)
+        texts.extend(result.text for result in results)
+    return texts
+
+# 録音を(8*bar_count)分割し、全チャンクをまとめてWhisperで文字起こしして、キーワードからラベルを推定する関数
+def classify_whisper_chunks(y, sr, tempo, bar_count):
+    beat_duration = 60.0 / tempo
+    total_duration = beat_duration * 4 * bar_count  # 小節数に応じた全体時間
+    chunk_duration = total_duration / (8 * bar_count)  # 各チャンクの長さ
+
+    # Whisperが出力した文字列に対してキック・スネア・ハイハットを識別するためのキーワード群
+    kick_keywords = ["ボ", "ぼ", "ぶ", "ブ", "ダ", "だ", "ド", "ど", "デ", "で", "B"]
+    hihat_keywords = ["ツ", "つ", "チ", "ち", "2"]
+    snare_keywords = ["パ", "ぱ"]
+
+    segments = []
+
+    # 音声を(8*bar_count)分割し、全チャンクをまとめてWhisperで文字起こしして分類する
+    bounds = []
+    chunks = []
+    for i in range(8 * bar_count):
+        start = i * chunk_duration
+        end = start + chunk_duration
+        # デコード済みのPCMをメモリ上で切り出す
+        bounds.append((start, end))
+        chunks.append(y[int(start * sr):int(end * sr)])
+
+    with stage("whisper"):
+        texts = transcribe_chunks(chunks)
+
+    for (start, end), text in zip(bounds, texts):
+        if any(k in text for k in kick_keywords):
+            label = "kick"
+        elif any(k in text for k in hihat_keywords):
+            label = "hihat"
+        elif any(k in text for k in snare_keywords):
+            label = "snare"
+        else:
+            label = "不明"
+
+        segments.append({"label": label, "start": round(start, 2), "end": round(end, 2)})
+
+    return {
+        "text": " | ".join(s["label"] for s in segments),
+        "segments": segments
+    }
 
 # --------------------------
 # Whisperによる解析
@@ -27,76 +105,46 @@ def analyze_whisper():
     if not file:
         return jsonify({"error": "No file"}), 400
 
-    path = "temp_whisper.wav"
-    file.save(path)
-    result = whisper_model.transcribe(path, language="ja")
+    # 一時ファイルを経由せず、デコード済みのPCMをそのままWhisperに渡す
+    try:
+        y = decode_audio(file.read())
+    except DecoderBusy as e:
+        return jsonify({"error": str(e)}), 503
+    with stage("whisper"):
+        result = models.get("whisper").transcribe(y, language="ja")
     return jsonify({"text": result["text"]})
 
 # 音声ファイルとテンポ情報を受け取り、1小節を8分割して分類ラベルを推定するエンドポイント
 @whisper_bp.route("/analyze", methods=["POST"])
 def analyze():
-    print("✅ /analyze にリクエスト来たよ！")
-    print("📦 リクエスト内容：", request.files)
+    logger.debug("✅ /analyze にリクエスト来たよ！ 📦 %s", request.files)
     if "file" not in request.files:
-        print("No file received!") 
+        logger.warning("No file received!")
         return jsonify({"error": "No file uploaded"}), 400
 
     file = request.files["file"]
     # テンポから1小節の長さを計算し、8分割されたチャンクの長さを求める
     tempo = float(request.form.get("tempo", 120))  # default tempo = 120
     bar_count = int(request.form.get("bar_count", 1))  # default 1 bar
+    data = file.read()
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp_webm:
-        file.save(tmp_webm.name)
-        webm_path = tmp_webm.name
+    # 同じ録音・同じ設定の結果がキャッシュにあれば、デコードや Whisper を行わずに返す
+    key = cache_key("analyze", data, f"whisper:{WHISPER_MODEL}", tempo=tempo, bar_count=bar_count)
+    cached = result_cache.get(key)
+    if cached is not None:
+        logger.debug("♻️ キャッシュ済みの結果を返します")
+        return jsonify(cached), 200
 
-    wav_path = webm_path.replace(".webm", ".wav")
+    # アップロードされた音声をメモリ上で 16kHz モノラル PCM にデコード
     try:
-        ffmpeg.input(webm_path).output(wav_path).run(quiet=True, overwrite_output=True)
-
-        beat_duration = 60.0 / tempo
-        total_duration = beat_duration * 4 * bar_count  # 小節数に応じた全体時間
-        chunk_duration = total_duration / (8 * bar_count)  # 各チャンクの長さ
-
-        # Whisperが出力した文字列に対してキック・スネア・ハイハットを識別するためのキーワード群
-        kick_keywords = ["ボ", "ぼ", "ぶ", "ブ", "ダ", "だ", "ド", "ど", "デ", "で", "B"]
-        hihat_keywords = ["ツ", "つ", "チ", "ち", "2"]
-        snare_keywords = ["パ", "ぱ"]
-
-        segments = []
-
-        # 音声を(8*bar_count)分割し、それぞれをWhisperで文字起こしして分類する
-        for i in range(8 * bar_count):
-            start = i * chunk_duration
-            end = start + chunk_duration
-            chunk_path = wav_path.replace(".wav", f"_chunk{i}.wav")
-            ffmpeg.input(wav_path, ss=start, t=chunk_duration).output(chunk_path).run(quiet=True, overwrite_output=True)
-
-            result = whisper_model.transcribe(chunk_path, language="ja")
-            text = result["text"]
-
-            if any(k in text for k in kick_keywords):
-                label = "kick"
-            elif any(k in text for k in hihat_keywords):
-                label = "hihat"
-            elif any(k in text for k in snare_keywords):
-                label = "snare"
-            else:
-                label = "不明"
-
-            segments.append({"label": label, "start": round(start, 2), "end": round(end, 2)})
-
-            # 一時的に生成したチャンクファイルを削除
-            os.remove(chunk_path)
-
-        return jsonify({
-            "text": " | ".join(s["label"] for s in segments),
-            "segments": segments
-        }), 200
-    # 元のwebmファイルと変換後のwavファイルを削除して後始末
-    finally:
-        for path in [webm_path, wav_path]:
-            if os.path.exists(path):
-                os.remove(path)
-
-__all__ = ["whisper_bp"]
\ No newline at end of file
+        y = decode_audio(data)
+    except DecoderBusy as e:
+        logger.warning("⏳ デコーダー混雑: %s", e)
+        return jsonify({"error": str(e)}), 503
+    sr = SAMPLE_RATE
+
+    result = classify_whisper_chunks(y, sr, tempo, bar_count)
+    result_cache.put(key, result)
+    return jsonify(result), 200
+
+__all__ = ["whisper_bp", "classify_whisper_chunks", "transcribe_chunks"]
\ No newline at end of file